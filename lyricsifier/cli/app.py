@@ -1,11 +1,169 @@
 from cement.core.foundation import CementApp
 from cement.ext.ext_argparse import ArgparseController, expose
 from lyricsifier.core.crawler import MetroLyricsCrawler
+from lyricsifier.core.urlbuilder import __builders__
 from lyricsifier.core.job \
-    import ClassifyJob, ClusterJob, ExtractJob, TagJob, VectorizeJob
+    import ArchiveExtractJob, ClassifyJob, ClusterJob, ExtractJob, \
+    RescoreJob, TagJob, URLJob, VectorizeJob
+from lyricsifier.core.utils import connection, metrics, ratelimit
+from lyricsifier.core.utils.httpcache import HTTPCache
+from lyricsifier.core.utils.tagcache import TagCache
 from lyricsifier.cli.utils import logging
 
 
+__connection_arguments__ = [
+    (['--cache-dir'],
+     dict(
+        help='''cache http responses in the given directory
+                (default no cache)''',
+        action='store',
+        default=None)
+     ),
+    (['--cache-ttl'],
+     dict(
+        help='''the amount of seconds a cached response is used without
+                revalidation (default 604800)''',
+        action='store',
+        default=604800)
+     ),
+    (['--cache-size'],
+     dict(
+        help='the max size of the http cache in MB (default 1024)',
+        action='store',
+        default=1024)
+     ),
+    (['--rate-limit'],
+     dict(
+        help='''the max amount of requests per second to a host shared by
+                all processes as HOST=RATE, can be repeated
+                (default ws.audioscrobbler.com=5)''',
+        action='append',
+        default=['ws.audioscrobbler.com=5'])
+     ),
+]
+
+
+__metrics_arguments__ = [
+    (['--metrics-file'],
+     dict(
+        help='''periodically write metrics in the Prometheus text format to
+                the given file (default no file)''',
+        action='store',
+        default=None)
+     ),
+    (['--metrics-port'],
+     dict(
+        help='''serve metrics in the Prometheus text format on
+                http://127.0.0.1:PORT/metrics (default no server)''',
+        action='store',
+        default=None)
+     ),
+    (['--metrics-interval'],
+     dict(
+        help='seconds between two writes of the metrics file (default 15)',
+        action='store',
+        default=15)
+     ),
+]
+
+
+__failure_arguments__ = [
+    (['-d', '--max-delay'],
+     dict(
+        help='''the max amount of seconds spent backing off on a track
+                before it fails (default 500)''',
+        action='store',
+        default=500)
+     ),
+    (['--defer-delay'],
+     dict(
+        help='''give up on transient failures after the given amount of
+                seconds backing off and retry them with --max-delay once
+                every other track is done (default no deferred retry)''',
+        action='store',
+        default=None)
+     ),
+    (['--failed-file'],
+     dict(
+        help='''the file the failed tracks are written to, with the reason
+                and the number of attempts (default the output file with
+                the .failed.tsv extension)''',
+        action='store',
+        default=None)
+     ),
+    (['--retry-failed'],
+     dict(
+        help='''retry the tracks in the failed file and append the ones
+                that succeed to the output file (default False)''',
+        action='store_true',
+        default=False)
+     ),
+]
+
+
+def failureOptions(pargs):
+    return dict(
+        max_delay=float(pargs.max_delay),
+        defer_delay=float(pargs.defer_delay) if pargs.defer_delay else None,
+        failed_file=pargs.failed_file,
+        retry_failed=pargs.retry_failed
+    )
+
+
+__genres_arguments__ = [
+    (['-g', '--genres-file'],
+     dict(
+        help='''a json file containing genres hierarchy, each genre may
+                list aliases next to its subgenres (default ./genres.json)''',
+        action='store',
+        default='./genres.json')
+     ),
+    (['--fuzzy-genres'],
+     dict(
+        help='''match tags to genres regardless of spaces and punctuation,
+                e.g. hip-hop and hiphop to hip hop (default False)''',
+        action='store_true',
+        default=False)
+     ),
+]
+
+
+def createTagger(pargs, cache=None):
+    import json
+    from lyricsifier.core.tagger import LastFMTagger
+    with open(pargs.genres_file, 'r', encoding='utf8') as f:
+        genres_json = json.load(f)
+    genres = {g['genre']: g['subgenres'] for g in genres_json}
+    aliases = {a: g['genre'] for g in genres_json
+               for a in g.get('aliases', [])}
+    return LastFMTagger(
+        'ac5188f22006a4ef88c6b83746b11118',
+        genres,
+        cache=cache,
+        aliases=aliases,
+        fuzzy=pargs.fuzzy_genres
+    )
+
+
+def setUpMetrics(pargs):
+    return metrics.Exporter(
+        file=pargs.metrics_file,
+        port=int(pargs.metrics_port) if pargs.metrics_port else None,
+        interval=float(pargs.metrics_interval)
+    )
+
+
+def setUpConnection(pargs):
+    connection.setRateLimiter(
+        ratelimit.RateLimiter(ratelimit.parse(pargs.rate_limit)))
+    if pargs.cache_dir:
+        connection.setCache(
+            HTTPCache(pargs.cache_dir,
+                      ttl=int(pargs.cache_ttl),
+                      max_size=int(pargs.cache_size) * 1024 * 1024)
+        )
+
+
 class BaseController(ArgparseController):
     class Meta:
         label = 'base'
@@ -41,14 +199,89 @@ class CrawlController(ArgparseController):
                 action='store',
                 default=300)
              ),
-        ]
+            (['-c', '--concurrency'],
+             dict(
+                help='number of pages fetched in parallel (default 1)',
+                action='store',
+                default=1)
+             ),
+            (['--host-limit'],
+             dict(
+                help='''the max number of parallel requests to the same host
+                        (default 4)''',
+                action='store',
+                default=4)
+             ),
+            (['--resume'],
+             dict(
+                help='''resume the crawl from the last checkpoint
+                        (default False)''',
+                action='store_true',
+                default=False)
+             ),
+        ] + __connection_arguments__ + __metrics_arguments__
     )
     def crawl(self):
+        setUpConnection(self.app.pargs)
         crawler = MetroLyricsCrawler(
             self.app.pargs.output_file,
-            int(self.app.pargs.max_delay)
+            int(self.app.pargs.max_delay),
+            concurrency=int(self.app.pargs.concurrency),
+            host_limit=int(self.app.pargs.host_limit),
+            resume=self.app.pargs.resume
         )
-        crawler.crawl()
+        with setUpMetrics(self.app.pargs):
+            crawler.crawl()
+
+
+class URLsController(ArgparseController):
+    class Meta:
+        label = 'urls'
+        stacked_on = 'base'
+
+    @expose(hide=True)
+    def default(self):
+        pass
+
+    @expose(
+        help="build the lyrics urls of the given tracks",
+        arguments=[
+            (['file'],
+             dict(
+                help='''a tsv file containing artist and title of tracks,
+                        and trackid (default the index of the row from 0)''',
+                action='store')
+             ),
+            (['-o', '--output-file'],
+             dict(
+                help='the output file (default ./target/urls.tsv)',
+                action='store',
+                default='./target/urls.tsv')
+             ),
+            (['-p', '--processes'],
+             dict(
+                help='number of parallel processes (default 1)',
+                action='store',
+                default=1)
+             ),
+            (['-s', '--source'],
+             dict(
+                help='''a site to build urls for, can be repeated
+                        (default all)''',
+                action='append',
+                choices=sorted(__builders__),
+                default=None)
+             ),
+        ]
+    )
+    def build(self):
+        job = URLJob(
+            self.app.pargs.file,
+            self.app.pargs.output_file,
+            sources=self.app.pargs.source,
+            processes=int(self.app.pargs.processes)
+        )
+        job.start()
 
 
 class ExtractController(ArgparseController):
@@ -71,25 +304,83 @@ class ExtractController(ArgparseController):
              ),
             (['-p', '--processes'],
              dict(
-                help='number of parallel processes (default 1)',
+                help='''number of parallel processes (default 1, all cores
+                        with --from-archive)''',
+                action='store',
+                default=None)
+             ),
+            (['--io-concurrency'],
+             dict(
+                help='''number of requests each process keeps in flight
+                        (default 1)''',
                 action='store',
                 default=1)
              ),
+            (['--resume'],
+             dict(
+                help='''skip the tracks already in the output file
+                        (default False)''',
+                action='store_true',
+                default=False)
+             ),
             (['file'],
              dict(
                 help='a tsv file containing the lyrics urls',
                 action='store',
-                nargs=1)
+                nargs='?')
              ),
-        ]
+            (['--archive-dir'],
+             dict(
+                help='''archive the fetched pages in the given directory
+                        (default no archive)''',
+                action='store',
+                default=None)
+             ),
+            (['--from-archive'],
+             dict(
+                help='''extract lyrics from the pages archived in the given
+                        directory instead of fetching them''',
+                action='store',
+                default=None)
+             ),
+            (['--parser'],
+             dict(
+                help='''the html parser, lxml is used only if installed
+                        (default html.parser)''',
+                action='store',
+                choices=['html.parser', 'lxml'],
+                default='html.parser')
+             ),
+        ] + __failure_arguments__ + __connection_arguments__ +
+        __metrics_arguments__
     )
     def extract(self):
+        processes = self.app.pargs.processes
+        if self.app.pargs.from_archive:
+            job = ArchiveExtractJob(
+                self.app.pargs.from_archive,
+                self.app.pargs.output_file,
+                processes=int(processes) if processes else None,
+                parser=self.app.pargs.parser
+            )
+            with setUpMetrics(self.app.pargs):
+                job.start()
+            return
+        if not self.app.pargs.file:
+            self.app.args.error('the file argument is required')
+        setUpConnection(self.app.pargs)
         job = ExtractJob(
-            self.app.pargs.file[0],
+            self.app.pargs.file,
             self.app.pargs.output_file,
-            processes=int(self.app.pargs.processes)
+            processes=int(processes) if processes else 1,
+            parser=self.app.pargs.parser,
+            archive_dir=self.app.pargs.archive_dir,
+            io_concurrency=int(self.app.pargs.io_concurrency),
+            resume=self.app.pargs.resume,
+            **failureOptions(self.app.pargs)
         )
-        job.start()
+        with setUpMetrics(self.app.pargs):
+            job.start()
 
 
 class TagController(ArgparseController):
@@ -104,13 +395,6 @@ class TagController(ArgparseController):
     @expose(
         help="tag the given tracks",
         arguments=[
-            (['-g', '--genres-file'],
-             dict(
-                help='''a json file containing genres hierarchy
-                        (default ./genres.json)''',
-                action='store',
-                default='./genres.json')
-             ),
             (['-o', '--output-file'],
              dict(
                 help='the output file (default ./target/tags.tsv)',
@@ -123,30 +407,112 @@ class TagController(ArgparseController):
                 action='store',
                 default=1)
              ),
+            (['--io-concurrency'],
+             dict(
+                help='''number of requests each process keeps in flight
+                        (default 1)''',
+                action='store',
+                default=1)
+             ),
+            (['--resume'],
+             dict(
+                help='''skip the tracks already in the output file
+                        (default False)''',
+                action='store_true',
+                default=False)
+             ),
+            (['--by-artist'],
+             dict(
+                help='''tag each artist once and give its tag to all of its
+                        tracks (default False)''',
+                action='store_true',
+                default=False)
+             ),
+            (['--granularity'],
+             dict(
+                help='''tag each track by the tags of its artist, by its own
+                        tags, or by its own tags falling back to those of
+                        its artist (default artist)''',
+                action='store',
+                choices=['artist', 'track', 'track-then-artist'],
+                default='artist')
+             ),
+            (['--tag-cache'],
+             dict(
+                help='''cache the tags of artists and tracks in the given
+                        file, shared by all processes and runs
+                        (default no cache)''',
+                action='store',
+                default=None)
+             ),
+            (['--tag-cache-ttl'],
+             dict(
+                help='''the amount of seconds cached tags are used
+                        (default 2592000)''',
+                action='store',
+                default=2592000)
+             ),
+            (['--tag-cache-negative-ttl'],
+             dict(
+                help='''the amount of seconds an artist or track without
+                        tags is not looked up again (default 604800)''',
+                action='store',
+                default=604800)
+             ),
             (['file'],
              dict(
                 help='a tsv file containing tracks id, artist and title',
                 action='store',
                 nargs=1)
              ),
-        ]
+        ] + __genres_arguments__ + __failure_arguments__ +
+        __connection_arguments__ + __metrics_arguments__
     )
     def tag(self):
-        import json
-        from lyricsifier.core.tagger import LastFMTagger
-        genres = {}
-        with open(self.app.pargs.genres_file, 'r', encoding='utf8') as f:
-            genres_json = json.load(f)
-            genres = {g['genre']: g['subgenres'] for g in genres_json}
-        tagger = LastFMTagger(
-            'ac5188f22006a4ef88c6b83746b11118',
-            genres
-        )
+        setUpConnection(self.app.pargs)
+        cache = None
+        if self.app.pargs.tag_cache:
+            cache = TagCache(
+                self.app.pargs.tag_cache,
+                ttl=int(self.app.pargs.tag_cache_ttl),
+                negative_ttl=int(self.app.pargs.tag_cache_negative_ttl)
+            )
+        tagger = createTagger(self.app.pargs, cache=cache)
         job = TagJob(
             self.app.pargs.file[0],
             self.app.pargs.output_file,
             taggers=[tagger, ],
-            processes=int(self.app.pargs.processes)
+            processes=int(self.app.pargs.processes),
+            io_concurrency=int(self.app.pargs.io_concurrency),
+            resume=self.app.pargs.resume,
+            by_artist=self.app.pargs.by_artist,
+            granularity=self.app.pargs.granularity,
+            **failureOptions(self.app.pargs)
+        )
+        with setUpMetrics(self.app.pargs):
+            job.start()
+
+    @expose(
+        help="tag again the Last.fm answers in an http cache directory",
+        arguments=[
+            (['cache_dir'],
+             dict(
+                help='the http cache directory of previous tag runs',
+                action='store')
+             ),
+            (['-o', '--output-file'],
+             dict(
+                help='the output file (default ./target/rescored.tsv)',
+                action='store',
+                default='./target/rescored.tsv')
+             ),
+        ] + __genres_arguments__
+    )
+    def rescore(self):
+        job = RescoreJob(
+            self.app.pargs.cache_dir,
+            self.app.pargs.output_file,
+            createTagger(self.app.pargs)
         )
         job.start()
 
@@ -279,7 +645,7 @@ class LyricsifierApp(CementApp):
         base_controller = 'base'
         handlers = [BaseController, ClassifyController, ClusterController,
                     CrawlController, ExtractController, TagController,
-                    VectorizeController]
+                    URLsController, VectorizeController]
 
 
 def main():
@@ -1,25 +1,41 @@
+import collections
 import csv
+import itertools
+import json
 import logging
 import os
 import re
-import time
 import urllib.request
 import urllib.error
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor
 from string import ascii_lowercase
-from lyricsifier.core.utils import connection, file, normalization as nutils
-from lyricsifier.core.utils.connection import SOFTConnError, FATALConnError
+from lyricsifier.core.utils \
+    import connection, file, metrics, normalization as nutils
+from lyricsifier.core.utils.retry import RetryError, RetryPolicy
 
 
 class MetroLyricsCrawler:
 
-    def __init__(self, fout, max_delay, max_depth=100):
+    def __init__(self, fout, max_delay, max_depth=100,
+                 concurrency=1, host_limit=4, frontier_size=None,
+                 resume=False):
         self.base_url = 'http://www.metrolyrics.com'
         self.artists_index = ['1'] + list(ascii_lowercase)
         self.artists_page_pattern = self.base_url + '/artists-{:s}-{:d}.html'
         self.fout = fout
+        self.fcheckpoint = fout + '.checkpoint'
+        self.resume = resume
+        self.checkpoint = None
         self.max_delay = max_delay
         self.max_depth = max_depth
+        self.concurrency = concurrency
+        self.frontier_size = frontier_size or concurrency * 4
+        self.index_lookahead = 2
+        self.limiter = connection.HostLimiter(host_limit)
+        # no circuit breaker, a page the crawler gives up on is lost for
+        # good, so every request gets the whole retry budget
+        self.retry = RetryPolicy(max_delay)
         self.currid = 0
         self.tsv_headers = ['trackid', 'url', 'artist', 'title']
         self.log = logging.getLogger(__name__)
@@ -27,14 +43,67 @@ class MetroLyricsCrawler:
     def _setUp(self):
         self.log.info('setting up')
         file.mkdirs(os.path.dirname(self.fout), safe=True)
-        with open(self.fout, 'w', encoding='utf8') as tsvout:
-            writer = csv.DictWriter(tsvout,
-                                    delimiter='\t',
-                                    fieldnames=self.tsv_headers)
-            writer.writeheader()
+        if self.resume:
+            self.checkpoint = self._loadCheckpoint()
+        if self.checkpoint:
+            self.currid = self.checkpoint['currid']
+            self._truncate(self.currid)
+            if not self.checkpoint.get('completed'):
+                self.log.info(
+                    'resuming from index \'{:s}\' page {:d} - trackid {:d}'
+                    .format(self.checkpoint['index'],
+                            self.checkpoint['artists_page'],
+                            self.currid))
+        else:
+            if os.path.exists(self.fcheckpoint):
+                os.remove(self.fcheckpoint)
+            with open(self.fout, 'w', encoding='utf8') as tsvout:
+                writer = csv.DictWriter(tsvout,
+                                        delimiter='\t',
+                                        fieldnames=self.tsv_headers)
+                writer.writeheader()
         self.log.debug('max delay: {:d}'.format(self.max_delay))
         self.log.debug('max depth: {:d}'.format(self.max_depth))
+        self.log.debug('concurrency: {:d}'.format(self.concurrency))
+        self.log.debug('frontier size: {:d}'.format(self.frontier_size))
+        self.log.debug('per host limit: {:d}'.format(self.limiter.limit))
         self.log.debug('output file: {:s}'.format(self.fout))
+        self.log.debug('checkpoint file: {:s}'.format(self.fcheckpoint))
+
+    def _loadCheckpoint(self):
+        if not (os.path.exists(self.fcheckpoint) and
+                os.path.exists(self.fout)):
+            self.log.warning('no checkpoint found - starting from scratch')
+            return None
+        with open(self.fcheckpoint, 'r', encoding='utf8') as fin:
+            checkpoint = json.load(fin)
+        self.log.info('checkpoint loaded - {}'.format(checkpoint))
+        return checkpoint
+
+    def _saveCheckpoint(self, checkpoint):
+        tmp = self.fcheckpoint + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as fout:
+            json.dump(checkpoint, fout)
+        os.replace(tmp, self.fcheckpoint)
+        self.checkpoint = checkpoint
+
+    def _truncate(self, currid):
+        # drops rows written after the last checkpoint, if any, so that
+        # resuming never produces duplicate rows; a last row without its
+        # line end was cut by a crash, even its trackid may be partial
+        with open(self.fout, 'rb+') as tsv:
+            tsv.readline()
+            offset = tsv.tell()
+            for line in iter(tsv.readline, b''):
+                trackid = line.split(b'\t', 1)[0]
+                if not line.endswith(b'\n') or not trackid.isdigit() or \
+                        int(trackid) > currid:
+                    break
+                offset = tsv.tell()
+            if offset < os.fstat(tsv.fileno()).st_size:
+                self.log.warning(
+                    'dropping rows written after trackid {:d}'.format(currid))
+                tsv.truncate(offset)
 
     def _batchWrite(self, rows):
         with open(self.fout, 'a', encoding='utf8') as tsvout:
@@ -48,34 +117,33 @@ class MetroLyricsCrawler:
         self.log.info('requesting URL {:s}'.format(url))
         return urllib.request.Request(url)
 
-    def _sleep(self, secs):
-        self.log.warning(
-            'going to sleep for {:d} seconds'.format(secs))
-        time.sleep(secs)
+    def _fetch(self, request):
+        with self.limiter.acquire(request.host):
+            response = connection.open(request)
+            return response.geturl(), connection.read(response)
 
     def _open(self, request):
-        delay = 1
-        while delay < self.max_delay:
-            try:
-                return connection.open(request)
-            except SOFTConnError as e:
-                self.log.error(e)
-                delay *= 2
-                self._sleep(delay)
-            except FATALConnError as e:
-                self.log.error(e)
-                return None
-        return None
+        try:
+            return self.retry.call(request.host, self._fetch, request)
+        except RetryError as e:
+            self.log.error(e)
+            return None
 
     def _requestArtistsPage(self, idx, page):
         url = self.artists_page_pattern.format(str(idx), page)
         request = self._request(url)
-        return url, self._open(request)
+        response = self._open(request)
+        metrics.inc('lyricsifier_crawl_pages_total', kind='artists',
+                    result='ok' if response else 'failed')
+        return url, response
 
     def _requestSongsPage(self, pattern, page):
         url = pattern.format(page)
         request = self._request(url)
-        return url, self._open(request)
+        response = self._open(request)
+        metrics.inc('lyricsifier_crawl_pages_total', kind='songs',
+                    result='ok' if response else 'failed')
+        return url, response
 
     def _extractArtistName(self, a_elem):
         text = nutils.encode(a_elem.get_text())
@@ -102,77 +170,160 @@ class MetroLyricsCrawler:
                 nutils.decode(title), a_elem.prettify()))
         return title
 
-    def _parseSongsTable(self, artist, table):
+    def _parseSongsTable(self, table):
         self.log.info('parsing songs table')
-        output_rows = []
+        songs = []
         for row in table.tbody.findAll('tr'):
             song_a = row.find('td', class_=None).find_next('a', href=True)
             title = self._extractSongTitle(song_a)
             lyrics_url = song_a['href']
-            output_rows.append(
-                {'trackid': self.currid + 1,
-                 'url': lyrics_url,
-                 'artist': nutils.decode(artist),
-                 'title': nutils.decode(title)}
-            )
-            self.currid += 1
+            songs.append((lyrics_url, title))
             self.log.info('new lyrics URL crawled - {:s}'.format(lyrics_url))
-        self._batchWrite(output_rows)
+        return songs
 
     def _parseArtistsTable(self, table):
         self.log.info('parsing artists table')
+        artists = []
         for row in table.tbody.findAll('tr'):
             artist_a = row.find('td').find_next('a', href=True)
             artist = self._extractArtistName(artist_a)
             songs_pattern = self._extractArtistSongsPagePattern(artist_a)
-            page = 1
+            artists.append((artist, songs_pattern))
+        return artists
+
+    def _crawlArtist(self, artist, songs_pattern, page=1):
+        pages = []
+        url, response = self._requestSongsPage(songs_pattern, page)
+        while response and url == response[0]:
+            soup = BeautifulSoup(response[1], 'html.parser')
+            table = soup.find('table', class_='songs-table compact')
+            if table:
+                pages.append((page, self._parseSongsTable(table)))
+            else:
+                self.log.warning(
+                    'cannot crawl from {:s} - skipping'.format(url))
+            page += 1
+            if page > self.max_depth:
+                self.log.warning('reached max depth - skipping')
+                break
             url, response = self._requestSongsPage(songs_pattern, page)
-            while response and url == response.geturl():
-                html = response.read()
-                soup = BeautifulSoup(html, 'html.parser')
-                table = soup.find('table', class_='songs-table compact')
-                if table:
-                    self._parseSongsTable(artist, table)
-                else:
-                    self.log.warning(
-                        'cannot crawl from {:s} - skipping'.format(url))
-                page += 1
-                if page > self.max_depth:
-                    self.log.warning('reached max depth - skipping')
-                    break
-                url, response = self._requestSongsPage(songs_pattern, page)
-            if response:
-                self.log.info(
-                    'no more songs for artist {:s}'.format(
-                        nutils.decode(artist)))
+        if response:
+            self.log.info(
+                'no more songs for artist {:s}'.format(
+                    nutils.decode(artist)))
+        else:
+            self.log.warning('cannot open URL {:s} - skipping'.format(url))
+        return pages
+
+    def _crawlIndex(self, idx, page=1):
+        self.log.info('crawling index \'{:s}\''.format(idx))
+        artists = []
+        url, response = self._requestArtistsPage(idx, page)
+        while response and url == response[0]:
+            soup = BeautifulSoup(response[1], 'html.parser')
+            table = soup.find('table', class_='songs-table')
+            if table:
+                artists.extend(
+                    (idx, page, pos, artist, songs_pattern)
+                    for pos, (artist, songs_pattern)
+                    in enumerate(self._parseArtistsTable(table)))
             else:
-                self.log.warning('cannot open URL {:s} - skipping'.format(url))
+                self.log.warning(
+                    'cannot crawl from {:s} - skipping'.format(url))
+            page += 1
+            if page > self.max_depth:
+                self.log.warning('reached max depth - skipping')
+                break
+            url, response = self._requestArtistsPage(idx, page)
+        if response:
+            self.log.info('no more page for index \'{:s}\''.format(idx))
+        else:
+            self.log.warning('cannot open URL {:s} - skipping'.format(url))
+        return artists
+
+    def _writeArtist(self, entry, pages):
+        idx, artists_page, pos, artist, songs_pattern = entry
+        for songs_page, songs in pages:
+            output_rows = []
+            for lyrics_url, title in songs:
+                self.currid += 1
+                output_rows.append(
+                    {'trackid': self.currid,
+                     'url': lyrics_url,
+                     'artist': nutils.decode(artist),
+                     'title': nutils.decode(title)}
+                )
+            self._batchWrite(output_rows)
+            metrics.inc('lyricsifier_crawl_songs_total', len(output_rows))
+            self._saveCheckpoint(
+                {'index': idx,
+                 'artists_page': artists_page,
+                 'artist': pos,
+                 'songs_pattern': songs_pattern,
+                 'songs_page': songs_page,
+                 'currid': self.currid}
+            )
+
+    def _resumeFrom(self, entry):
+        # returns the first songs page to crawl for the given artist,
+        # or None if the artist was already crawled before the checkpoint
+        if not self.checkpoint:
+            return 1
+        idx, artists_page, pos, artist, songs_pattern = entry
+        cp = self.checkpoint
+        if idx != cp['index']:
+            return 1
+        if (artists_page, pos) < (cp['artists_page'], cp['artist']):
+            return None
+        if (artists_page, pos) == (cp['artists_page'], cp['artist']) \
+                and songs_pattern == cp['songs_pattern']:
+            return cp['songs_page'] + 1
+        return 1
 
     def _browse(self):
-        for idx in self.artists_index:
-            self.log.info('crawling index \'{:s}\''.format(idx))
-            page = 1
-            url, response = self._requestArtistsPage(idx, page)
-            while response and url == response.geturl():
-                html = response.read()
-                soup = BeautifulSoup(html, 'html.parser')
-                table = soup.find('table', class_='songs-table')
-                if table:
-                    self._parseArtistsTable(table)
-                else:
-                    self.log.warning(
-                        'cannot crawl from {:s} - skipping'.format(url))
-                page += 1
-                if page > self.max_depth:
-                    self.log.warning('reached max depth - skipping')
-                    break
-                url, response = self._requestArtistsPage(idx, page)
-            if response:
-                self.log.info('no more page for index \'{:s}\''.format(idx))
-            else:
-                self.log.warning('cannot open URL {:s} - skipping'.format(url))
+        # pages are fetched concurrently, but results are consumed in the
+        # same order as a serial crawl so that trackids are deterministic
+        artists_index = self.artists_index
+        first_page = {}
+        if self.checkpoint:
+            idx = self.checkpoint['index']
+            artists_index = artists_index[artists_index.index(idx):]
+            first_page[idx] = self.checkpoint['artists_page']
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = iter(artists_index)
+            indexes = collections.deque(
+                pool.submit(self._crawlIndex, idx, first_page.get(idx, 1))
+                for idx in itertools.islice(pending, self.index_lookahead))
+            frontier = collections.deque()
+            while indexes:
+                artists = indexes.popleft().result()
+                for idx in itertools.islice(pending, 1):
+                    indexes.append(
+                        pool.submit(
+                            self._crawlIndex, idx, first_page.get(idx, 1)))
+                for entry in artists:
+                    page = self._resumeFrom(entry)
+                    if page is None:
+                        continue
+                    if len(frontier) >= self.frontier_size:
+                        entry_done, future = frontier.popleft()
+                        self._writeArtist(entry_done, future.result())
+                    artist, songs_pattern = entry[3:]
+                    frontier.append(
+                        (entry,
+                         pool.submit(
+                             self._crawlArtist, artist, songs_pattern, page))
+                    )
+            while frontier:
+                entry_done, future = frontier.popleft()
+                self._writeArtist(entry_done, future.result())
 
     def crawl(self):
         self._setUp()
+        if self.checkpoint and self.checkpoint.get('completed'):
+            self.log.info('crawling already completed - nothing to resume')
+            return
         self._browse()
+        self._saveCheckpoint({'completed': True, 'currid': self.currid})
+        self.log.info('transfer stats: {}'.format(connection.stats()))
         self.log.info('crawling completed')
@@ -1,25 +1,50 @@
+import importlib.util
 import logging
 import re
+import urllib.parse
 import urllib.request
 import urllib.error
 from abc import ABC, abstractmethod
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from lyricsifier.core.utils import connection, normalization as nutils
 
 
+__parsers__ = ['html.parser', 'lxml']
+
+
 class URLError(Exception):
     pass
 
 
 class BaseExtractor(ABC):
 
-    def __init__(self, regex):
+    def __init__(self, host, regex, strainer=None):
+        self.host = host
         self.urlCheckRegex = re.compile(regex)
+        self.strainer = strainer
+        self.parser = 'html.parser'
+        self.fast = True
         self.log = logging.getLogger(__name__)
 
     def __str__(self):
         return self.__class__.__name__
 
+    def useParser(self, parser, fast=True):
+        if parser not in __parsers__:
+            raise ValueError('unknown parser {}'.format(parser))
+        if parser == 'lxml' and not importlib.util.find_spec('lxml'):
+            self.log.warning('lxml is not installed - using html.parser')
+            parser = 'html.parser'
+        self.parser = parser
+        self.fast = fast
+
+    def _parse(self, html, full=False):
+        # the fast path only builds the subtree matched by the strainer
+        # instead of the whole page
+        if self.fast and not full:
+            return BeautifulSoup(html, self.parser, parse_only=self.strainer)
+        return BeautifulSoup(html, self.parser)
+
     @abstractmethod
     def extractFromHTML(self, html):
         pass
@@ -27,7 +52,7 @@ class BaseExtractor(ABC):
     def canExtractFromURL(self, url):
         return self.urlCheckRegex.match(url)
 
-    def extractFromURL(self, url):
+    def fetch(self, url):
         if not self.canExtractFromURL(url):
             raise URLError('{} cannot extract from URL {}'.format(self, url))
         self.log.info('loading page at URL {}'.format(url))
@@ -35,8 +60,40 @@ class BaseExtractor(ABC):
         response = connection.open(request)
         if url != response.geturl():
             self.log.warning('redirected to {}'.format(response.geturl()))
-        html = connection.read(response)
-        return self.extractFromHTML(html)
+        return connection.read(response)
+
+    def extractFromURL(self, url):
+        return self.extractFromHTML(self.fetch(url))
+
+
+class ExtractorRegistry:
+
+    def __init__(self, extractors=()):
+        self.extractors = {}
+        for extractor in extractors:
+            self.register(extractor)
+        self.log = logging.getLogger(__name__)
+
+    def __str__(self):
+        return str([str(e) for e in self.extractors.values()])
+
+    def __iter__(self):
+        return iter(self.extractors.values())
+
+    def register(self, extractor):
+        self.extractors[extractor.host] = extractor
+
+    def select(self, url):
+        # dispatch on the hostname, the url regex is only used to validate
+        # the url against the selected extractor
+        extractor = self.extractors.get(urllib.parse.urlsplit(url).hostname)
+        if extractor and extractor.canExtractFromURL(url):
+            return extractor
+        return None
+
+
+def _azlyricsDiv(css_class):
+    return css_class is None or css_class == 'lyricsh'
 
 
 class MetroLyricsExtractor(BaseExtractor):
@@ -44,12 +101,14 @@ class MetroLyricsExtractor(BaseExtractor):
     def __init__(self):
         BaseExtractor.__init__(
             self,
-            '^http://www.metrolyrics.com/[a-z0-9-]+-lyrics-[a-z0-9-]+\.html'
+            'www.metrolyrics.com',
+            '^http://www.metrolyrics.com/[a-z0-9-]+-lyrics-[a-z0-9-]+\.html',
+            strainer=SoupStrainer(id='lyrics-body-text')
         )
 
     def extractFromHTML(self, html):
         self.log.info('parsing html')
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = self._parse(html)
         div = soup.find(id='lyrics-body-text')
         if not div:
             self.log.warning('unable to extract')
@@ -68,12 +127,14 @@ class LyricsComExtractor(BaseExtractor):
     def __init__(self):
         BaseExtractor.__init__(
             self,
-            '^http://www.lyrics.com/[a-z0-9-]+-lyrics-[a-z0-9-]+\.html'
+            'www.lyrics.com',
+            '^http://www.lyrics.com/[a-z0-9-]+-lyrics-[a-z0-9-]+\.html',
+            strainer=SoupStrainer(id='lyrics')
         )
 
     def extractFromHTML(self, html):
         self.log.info('parsing html')
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = self._parse(html)
         div = soup.find(id='lyrics')
         if not div:
             self.log.warning('unable to extract')
@@ -89,12 +150,14 @@ class LyricsModeExtractor(BaseExtractor):
     def __init__(self):
         BaseExtractor.__init__(
             self,
-            '^http://www.lyricsmode.com/lyrics/([a-z]|0-9)/[a-z0-9_]+/[a-z0-9_]+\.html'
+            'www.lyricsmode.com',
+            '^http://www.lyricsmode.com/lyrics/([a-z]|0-9)/[a-z0-9_]+/[a-z0-9_]+\.html',
+            strainer=SoupStrainer(id='lyrics_text')
         )
 
     def extractFromHTML(self, html):
         self.log.info('parsing html')
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = self._parse(html)
         p = soup.find(id='lyrics_text')
         if not p:
             self.log.warning('unable to extract')
@@ -110,13 +173,19 @@ class AZLyricsExtractor(BaseExtractor):
     def __init__(self):
         BaseExtractor.__init__(
             self,
-            '^http://www.azlyrics.com/lyrics/[a-z0-9]+/[a-z0-9]+\.html'
+            'www.azlyrics.com',
+            '^http://www.azlyrics.com/lyrics/[a-z0-9]+/[a-z0-9]+\.html',
+            strainer=SoupStrainer('div', class_=_azlyricsDiv)
         )
 
     def extractFromHTML(self, html):
         self.log.info('parsing html')
-        soup = BeautifulSoup(html, 'html.parser')
-        div = soup.find(class_='lyricsh').find_next('div', class_=None)
+        soup = self._parse(html)
+        header = soup.find(class_='lyricsh')
+        if not header and self.fast:
+            # the header is not a div, only a full parse can find it
+            header = self._parse(html, full=True).find(class_='lyricsh')
+        div = header.find_next('div', class_=None) if header else None
         if not div:
             self.log.warning('unable to extract')
             return None
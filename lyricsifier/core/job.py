@@ -1,164 +1,517 @@
 
+import copy
 import csv
 import logging
+import multiprocessing
 import os
 import pickle
-import tempfile
+import shutil
+import signal
+import urllib.parse
 from lyricsifier.core.classification \
     import Dataset, KMeansAlgorithm, DBScanAlgorithm, AffinityPropagation, \
     PerceptronAlgorithm, MultinomialNBAlgorithm, RandomForestAlgorithm, \
     SVMAlgorithm, MLPAlgorithm
 from lyricsifier.core.extractor \
-    import MetroLyricsExtractor, LyricsComExtractor, \
+    import ExtractorRegistry, MetroLyricsExtractor, LyricsComExtractor, \
     LyricsModeExtractor, AZLyricsExtractor
+from lyricsifier.core.scheduler import Scheduler
+from lyricsifier.core.tagger import ConcurrentTagger
 from lyricsifier.core.vectorizer import LyricsVectorizer
-from lyricsifier.core.worker import ExtractWorker, TagWorker
-from lyricsifier.core.utils import csv as csvutils, file  # , plot
+from lyricsifier.core.urlbuilder import __builders__, buildURLs
+from lyricsifier.core.worker import ExtractWorker, TagWorker, Failure, \
+    initArchiveExtract, extractArchived
+from lyricsifier.core.utils \
+    import csv as csvutils, file, metrics, normalization as nutils  # , plot
+from lyricsifier.core.utils.archive import ArchiveReader
+from lyricsifier.core.utils.httpcache import HTTPCache
 
 
-class ExtractJob:
+__failure_fields__ = ['kind', 'reason', 'attempts']
+# failures that may not happen again later, they are worth a deferred retry
+__transient__ = ('soft', 'circuit')
 
-    __extractors__ = [MetroLyricsExtractor(), LyricsComExtractor(),
-                      LyricsModeExtractor(), AZLyricsExtractor(), ]
 
-    def __init__(self, fin, fout, extractors=__extractors__, processes=1):
+class QueueJob:
+
+    # Tracks that fail are written to a dead-letter file together with the
+    # kind of failure, its reason and the number of attempts, after the
+    # columns of the input so that the file can be used as input again.
+    # With defer_delay the workers give up on transient failures after
+    # defer_delay seconds of back-off and put them aside, they are retried
+    # with the whole max_delay once every other track is done.
+
+    def __init__(self, fin, fout, processes=1, batch_size=16,
+                 io_concurrency=1, resume=False, max_delay=500,
+                 defer_delay=None, failed_file=None, retry_failed=False):
         self.fin = fin
         self.fout = fout
         self.processes = processes
+        self.batch_size = batch_size
+        self.io_concurrency = io_concurrency
+        self.resume = resume
+        self.max_delay = max_delay
+        self.defer_delay = defer_delay
+        self.retry_failed = retry_failed
+        base = os.path.splitext(fout)[0]
+        self.ffailed = failed_file or base + '.failed.tsv'
+        self.fretry = os.path.splitext(self.ffailed)[0] + '.retrying.tsv'
+        self.fdeferred = base + '.deferred.tsv'
+        self.delay = max_delay
+        self.done = None
+        self.failed = 0
+        self.stop = multiprocessing.Event()
+        self.stopped = False
+        self.scheduler = None
+        # enough batches to keep every thread of a worker busy, plus one
+        # queued so that threads are not idle while the next one arrives
+        self.slots = -(-io_concurrency // batch_size)
+        if io_concurrency > 1:
+            self.slots += 1
+        self.tsv_headers = []
+        self.failed_headers = []
+        self.log = logging.getLogger(__name__)
+
+    def _setUp(self):
+        self.log.info('setting up')
+        file.mkdirs(os.path.dirname(self.fout), safe=True)
+        if self.retry_failed:
+            # the failed tracks are moved aside and retried, those failing
+            # again make up the new dead-letter file; a retry that was
+            # stopped is resumed
+            if not os.path.exists(self.fretry):
+                os.replace(self.ffailed, self.fretry)
+            self.log.info('retrying the tracks in {}'.format(self.fretry))
+            self.fin = self.fretry
+            self.resume = True
+        self.failed_headers = [h for h in csvutils.header(self.fin)
+                               if h not in __failure_fields__] + \
+            __failure_fields__
+        done = csvutils.IdSet()
+        for fout, headers in ((self.fout, self.tsv_headers),
+                              (self.ffailed, self.failed_headers)):
+            if self.resume and os.path.exists(fout):
+                dropped = csvutils.dropPartialRow(fout)
+                if dropped:
+                    self.log.warning('dropped {:d} bytes of a partial row '
+                                     'of {}'.format(dropped, fout))
+            if self.resume and os.path.exists(fout) and \
+                    os.path.getsize(fout) > 0:
+                # failed tracks are done too, --retry-failed retries them
+                for row in csvutils.stream(fout):
+                    done.add(row['trackid'])
+            else:
+                with open(fout, 'w', encoding='utf8') as tsvout:
+                    self._writer(tsvout, headers).writeheader()
+        if self.resume:
+            self.done = done
+            self.log.info(
+                'resuming, {:d} tracks already done'.format(len(done)))
+        self.log.debug('processes: {:d}'.format(self.processes))
+        self.log.debug('batch size: {:d}'.format(self.batch_size))
+        self.log.debug('io concurrency: {:d}'.format(self.io_concurrency))
+        self.log.debug('max delay: {}'.format(self.max_delay))
+        self.log.debug('defer delay: {}'.format(self.defer_delay))
+        self.log.debug('output file: {:s}'.format(self.fout))
+        self.log.debug('failed file: {:s}'.format(self.ffailed))
+
+    def _writer(self, f, fieldnames):
+        return csv.DictWriter(f,
+                              delimiter='\t',
+                              fieldnames=fieldnames,
+                              extrasaction='ignore')
+
+    def _createWorker(self, wid, channel):
+        pass
+
+    def _tracks(self):
+        tracks = csvutils.stream(self.fin)
+        if self.done:
+            tracks = (track for track in tracks
+                      if track['trackid'] not in self.done)
+        return tracks
+
+    def _group(self, tracks):
+        # the units handed out in batches, one track each by default
+        return tracks
+
+    def _ungroup(self, units):
+        return units
+
+    def _crashed(self, batch, crashes, exitcode):
+        # the tracks of a batch that crashed every worker it was given to
+        reason = 'crashed {:d} workers - last exit code {}'.format(
+            crashes, exitcode)
+        return [], [Failure(track, 'crash', reason, crashes).record()
+                    for track in self._ungroup(batch)]
+
+    def _run(self, tracks, delay, collect):
+        # a pass of the workers over tracks, giving up on a track after
+        # delay seconds of back-off; the passes share the scheduler
+        self.delay = delay
+        if self.scheduler is None:
+            self.scheduler = Scheduler(
+                self._createWorker,
+                collect,
+                processes=self.processes,
+                stop=self.stop,
+                crashed=self._crashed
+            )
+        scheduler = self.scheduler
+        scheduler.collect = collect
+
+        def interrupt(signum, frame):
+            if scheduler.stopping:
+                raise KeyboardInterrupt()
+            scheduler.shutdown()
+
+        handlers = {s: signal.signal(s, interrupt)
+                    for s in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            self.log.info('starting workers')
+            scheduler.run(
+                csvutils.chunks(self._group(tracks), self.batch_size))
+        finally:
+            for s, handler in handlers.items():
+                signal.signal(s, handler)
+        self.stopped = scheduler.stopping
+
+    def _runDeferring(self, collect):
+        deferred = 0
+        with open(self.fdeferred, 'w', encoding='utf8') as spoolout:
+            spool = self._writer(spoolout, self.failed_headers)
+            spool.writeheader()
+
+            def defer(payload):
+                nonlocal deferred
+                rows, failures = payload
+                transient = [f for f in failures if f['kind'] in __transient__]
+                spool.writerows(transient)
+                spoolout.flush()
+                deferred += len(transient)
+                metrics.inc('lyricsifier_tracks_deferred_total',
+                            len(transient))
+                collect((rows, [f for f in failures
+                                if f['kind'] not in __transient__]))
+
+            self._run(self._tracks(), self.defer_delay, defer)
+        # the deferred tracks are neither in the output nor in the
+        # dead-letter file, a resumed job processes them if stopped
+        if deferred and not self.stopped:
+            self.log.info('retrying {:d} deferred tracks'.format(deferred))
+            self._run(csvutils.stream(self.fdeferred), self.max_delay,
+                      collect)
+        os.remove(self.fdeferred)
+
+    def start(self):
+        if self.retry_failed and not (os.path.exists(self.fretry) or
+                                      os.path.exists(self.ffailed)):
+            self.log.warning(
+                'no {} - nothing to retry'.format(self.ffailed))
+            return
+        self._setUp()
+        # rows and failures are appended as soon as a batch is done, the
+        # output file can be read while the job is running
+        with open(self.fout, 'a', encoding='utf8') as tsvout, \
+                open(self.ffailed, 'a', encoding='utf8') as failout:
+            writer = self._writer(tsvout, self.tsv_headers)
+            failed = self._writer(failout, self.failed_headers)
+
+            def collect(payload):
+                rows, failures = payload
+                writer.writerows(rows)
+                tsvout.flush()
+                if failures:
+                    failed.writerows(failures)
+                    failout.flush()
+                    self.failed += len(failures)
+
+            if self.defer_delay is None:
+                self._run(self._tracks(), self.max_delay, collect)
+            else:
+                self._runDeferring(collect)
+        if self.stopped:
+            self.log.warning('job stopped before completion - '
+                             'run it again with --resume to finish it')
+        elif self.retry_failed:
+            os.remove(self.fretry)
+        if self.failed:
+            self.log.warning('{:d} tracks failed - they are listed in {}'
+                             .format(self.failed, self.ffailed))
+
+
+class ExtractJob(QueueJob):
+
+    __extractors__ = [MetroLyricsExtractor(), LyricsComExtractor(),
+                      LyricsModeExtractor(), AZLyricsExtractor(), ]
+
+    def __init__(self, fin, fout, extractors=__extractors__, processes=1,
+                 parser='html.parser', archive_dir=None, batch_size=16,
+                 io_concurrency=1, resume=False, max_delay=500,
+                 defer_delay=None, failed_file=None, retry_failed=False):
+        QueueJob.__init__(self, fin, fout, processes=processes,
+                          batch_size=batch_size,
+                          io_concurrency=io_concurrency, resume=resume,
+                          max_delay=max_delay, defer_delay=defer_delay,
+                          failed_file=failed_file,
+                          retry_failed=retry_failed)
+        self.archive_dir = archive_dir
+        # the extractors are shared, each job configures its own copies
+        extractors = [copy.copy(e) for e in extractors]
         self.extractors = extractors
+        for extractor in extractors:
+            extractor.useParser(parser)
+        self.registry = ExtractorRegistry(extractors)
+        self.tsv_headers = ['trackid', 'lyrics']
+
+    def _setUp(self):
+        QueueJob._setUp(self)
+        self.log.debug('extractors: {}'.format(self.extractors))
+        self.log.debug('archive directory: {}'.format(self.archive_dir))
+
+    def _createWorker(self, wid, channel):
+        return ExtractWorker(
+            wid,
+            channel,
+            registry=self.registry,
+            max_delay=self.delay,
+            archive_dir=self.archive_dir,
+            io_concurrency=self.io_concurrency,
+            slots=self.slots,
+            stop=self.stop
+        )
+
+    def start(self):
+        QueueJob.start(self)
+        self.log.info('extract job completed')
+
+
+class ArchiveExtractJob:
+
+    def __init__(self, archive_dir, fout,
+                 extractors=ExtractJob.__extractors__, processes=None,
+                 parser='html.parser'):
+        self.archive_dir = archive_dir
+        self.fout = fout
+        self.processes = processes or multiprocessing.cpu_count()
+        # the extractors are shared, each job configures its own copies
+        extractors = [copy.copy(e) for e in extractors]
+        self.extractors = extractors
+        for extractor in extractors:
+            extractor.useParser(parser)
+        self.registry = ExtractorRegistry(extractors)
         self.tsv_headers = ['trackid', 'lyrics']
         self.log = logging.getLogger(__name__)
 
     def _setUp(self):
         self.log.info('setting up')
         file.mkdirs(os.path.dirname(self.fout), safe=True)
-        with open(self.fout, 'w', encoding='utf8') as tsvout:
-            writer = csv.DictWriter(tsvout,
-                                    delimiter='\t',
-                                    fieldnames=self.tsv_headers)
-            writer.writeheader()
         self.log.debug('processes: {:d}'.format(self.processes))
-        self.log.debug('extractors: {}'.format(self.extractors))
+        self.log.debug('archive directory: {:s}'.format(self.archive_dir))
         self.log.debug('output file: {:s}'.format(self.fout))
 
-    def _createWorkers(self, tmpdir, splits):
-        self.log.info('creating workers')
-        workers = []
-        for i in range(self.processes):
-            wid = 'w{:d}'.format(i)
-            fout = os.path.join(tmpdir, wid)
-            tracks = splits[i]
-            workers.append(
-                ExtractWorker(
-                    wid,
-                    tracks,
-                    fout,
-                    extractors=self.extractors
-                )
-            )
-            self.log.info('worker {} created'.format(wid))
-        return workers
-
-    def _merge(self, workers):
-        self.log.info('merging output files')
-        with open(self.fout, 'a', encoding='utf8') as tsvout:
+    def start(self):
+        self._setUp()
+        entries = ArchiveReader(self.archive_dir).entries()
+        self.log.info('{:d} archived pages found'.format(len(entries)))
+        with open(self.fout, 'w', encoding='utf8') as tsvout, \
+                multiprocessing.Pool(self.processes,
+                                     initializer=initArchiveExtract,
+                                     initargs=(self.registry,)) as pool:
             writer = csv.DictWriter(tsvout,
                                     delimiter='\t',
                                     fieldnames=self.tsv_headers)
-            for worker in workers:
-                with open(worker.fout, 'r', encoding='utf8') as tsvin:
-                    reader = csv.DictReader(tsvin, delimiter='\t')
-                    for row in reader:
-                        writer.writerow(
-                            {'trackid': row['trackid'],
-                             'lyrics': row['lyrics']}
-                        )
+            writer.writeheader()
+            extracted = 0
+            for trackid, lyrics in pool.imap(extractArchived, entries,
+                                             chunksize=64):
+                metrics.inc('lyricsifier_tracks_total', job='archive',
+                            result='ok' if lyrics else 'failed')
+                if lyrics:
+                    writer.writerow({'trackid': trackid, 'lyrics': lyrics})
+                    extracted += 1
+                else:
+                    self.log.warning(
+                        'cannot extract track {} - skipping'.format(trackid))
+        self.log.info('{:d}/{:d} tracks extracted'.format(
+            extracted, len(entries)))
+        self.log.info('archive extract job completed')
+
+
+class TagJob(QueueJob):
+
+    def __init__(self, fin, fout, taggers, processes=1, batch_size=16,
+                 io_concurrency=1, resume=False, max_delay=500,
+                 defer_delay=None, failed_file=None, retry_failed=False,
+                 by_artist=False, granularity='artist'):
+        QueueJob.__init__(self, fin, fout, processes=processes,
+                          batch_size=batch_size,
+                          io_concurrency=io_concurrency, resume=resume,
+                          max_delay=max_delay, defer_delay=defer_delay,
+                          failed_file=failed_file,
+                          retry_failed=retry_failed)
+        # the threads of a worker share the calls in flight of a tagger
+        if io_concurrency > 1:
+            taggers = [ConcurrentTagger(t) for t in taggers]
+        self.taggers = taggers
+        self.by_artist = by_artist
+        self.granularity = granularity
+        self.tsv_headers = ['trackid', 'artist', 'title', 'tag']
+
+    def _setUp(self):
+        QueueJob._setUp(self)
+        self.log.debug('taggers: {}'.format(self.taggers))
+        self.log.debug('by artist: {}'.format(self.by_artist))
+        self.log.debug('granularity: {}'.format(self.granularity))
+
+    def _group(self, tracks):
+        if not self.by_artist:
+            return tracks
+        # the tracks of an artist make up a single unit, so a single worker
+        # tags the artist once for all of them; grouping needs the whole
+        # input, only the tracks left to do are held in memory
+        groups = {}
+        for track in tracks:
+            key = nutils.normalize(track['artist'])
+            if key not in groups:
+                groups[key] = {'artist': track['artist'], 'tracks': []}
+            groups[key]['tracks'].append(track)
+        self.log.info('{:d} artists to tag'.format(len(groups)))
+        return iter(groups.values())
+
+    def _ungroup(self, units):
+        if not self.by_artist:
+            return units
+        return [track for group in units for track in group['tracks']]
+
+    def _createWorker(self, wid, channel):
+        return TagWorker(
+            wid,
+            channel,
+            taggers=self.taggers,
+            max_delay=self.delay,
+            io_concurrency=self.io_concurrency,
+            slots=self.slots,
+            stop=self.stop,
+            by_artist=self.by_artist,
+            granularity=self.granularity
+        )
 
     def start(self):
-        self._setUp()
-        splits = csvutils.load(self.fin, splits=self.processes)
-        with tempfile.TemporaryDirectory() as tmpdir:
-            workers = self._createWorkers(tmpdir, splits)
-            self.log.info('starting workers')
-            for worker in workers:
-                worker.start()
-            self.log.info('waiting for workers...')
-            for worker in workers:
-                worker.join()
-            self._merge(workers)
-        self.log.info('extract job completed')
+        QueueJob.start(self)
+        self.log.info('tag job completed')
+
 
+class URLJob:
 
-class TagJob:
+    # builds the lyrics urls of every (artist, title) of fin for each
+    # source; with several processes each one builds a shard of the tracks
+    # in a part file and the parts are joined shard after shard
 
-    def __init__(self, fin, fout, taggers, processes=1):
+    def __init__(self, fin, fout, sources=None, processes=1):
         self.fin = fin
         self.fout = fout
+        self.sources = sources or list(__builders__)
         self.processes = processes
-        self.taggers = taggers
-        self.tsv_headers = ['trackid', 'artist', 'title', 'tag']
+        self.tsv_headers = ['trackid', 'artist', 'title', 'source', 'url']
         self.log = logging.getLogger(__name__)
 
     def _setUp(self):
         self.log.info('setting up')
         file.mkdirs(os.path.dirname(self.fout), safe=True)
+        for source in self.sources:
+            if source not in __builders__:
+                raise ValueError('unknown source {}'.format(source))
         with open(self.fout, 'w', encoding='utf8') as tsvout:
-            writer = csv.DictWriter(tsvout,
-                                    delimiter='\t',
-                                    fieldnames=self.tsv_headers)
-            writer.writeheader()
+            tsvout.write('\t'.join(self.tsv_headers) + '\n')
         self.log.debug('processes: {:d}'.format(self.processes))
-        self.log.debug('taggers: {}'.format(self.taggers))
+        self.log.debug('sources: {}'.format(self.sources))
         self.log.debug('output file: {:s}'.format(self.fout))
 
-    def _createWorkers(self, tmpdir, splits):
-        self.log.info('creating workers')
-        workers = []
-        for i in range(self.processes):
-            wid = 'w{:d}'.format(i)
-            fout = os.path.join(tmpdir, wid)
-            tracks = splits[i]
-            workers.append(
-                TagWorker(
-                    wid,
-                    tracks,
-                    fout,
-                    taggers=self.taggers
-                )
-            )
-            self.log.info('worker {} created'.format(wid))
-        return workers
+    def start(self):
+        self._setUp()
+        if self.processes == 1:
+            written = buildURLs(self.fin, self.fout, self.sources)
+        else:
+            parts = ['{}.part{:d}'.format(self.fout, shard)
+                     for shard in range(self.processes)]
+            for part in parts:
+                if os.path.exists(part):
+                    os.remove(part)
+            with multiprocessing.Pool(self.processes) as pool:
+                written = sum(pool.starmap(
+                    buildURLs,
+                    [(self.fin, part, self.sources, shard, self.processes)
+                     for shard, part in enumerate(parts)]))
+            with open(self.fout, 'ab') as tsvout:
+                for part in parts:
+                    with open(part, 'rb') as tsvin:
+                        shutil.copyfileobj(tsvin, tsvout)
+                    os.remove(part)
+        self.log.info('{:d} urls built'.format(written))
+        self.log.info('url job completed')
+
+
+class RescoreJob:
+
+    # tags again the Last.fm answers kept in an http cache directory, with
+    # the genres of the given tagger and without any request
+
+    __methods__ = ('artist.gettoptags', 'track.gettoptags')
+
+    def __init__(self, cache_dir, fout, tagger, batch_size=1024):
+        self.cache_dir = cache_dir
+        self.fout = fout
+        self.tagger = tagger
+        self.batch_size = batch_size
+        self.tsv_headers = ['artist', 'title', 'tag']
+        self.log = logging.getLogger(__name__)
+
+    def _setUp(self):
+        self.log.info('setting up')
+        file.mkdirs(os.path.dirname(self.fout), safe=True)
+        self.log.debug('cache directory: {:s}'.format(self.cache_dir))
+        self.log.debug('genres: {:d} names'.format(len(self.tagger.index)))
+        self.log.debug('output file: {:s}'.format(self.fout))
 
-    def _merge(self, workers):
-        self.log.info('merging output files')
-        with open(self.fout, 'a', encoding='utf8') as tsvout:
+    def _answers(self):
+        cache = HTTPCache(self.cache_dir)
+        prefix = self.tagger.base_url + '?'
+        for entry in cache.entries():
+            if not entry.get('url', '').startswith(prefix):
+                continue
+            params = dict(urllib.parse.parse_qsl(
+                urllib.parse.urlsplit(entry['url']).query))
+            if params.get('method') not in self.__methods__:
+                continue
+            response = cache.response(entry)
+            if response is None:
+                continue
+            try:
+                tags = self.tagger._parse(response)
+            except (ValueError, KeyError) as e:
+                self.log.warning('cannot parse the answer to {} - {}'
+                                 .format(entry['url'], e))
+                continue
+            yield params.get('artist', ''), params.get('track', ''), tags
+
+    def start(self):
+        self._setUp()
+        rescored = 0
+        with open(self.fout, 'w', encoding='utf8') as tsvout:
             writer = csv.DictWriter(tsvout,
                                     delimiter='\t',
                                     fieldnames=self.tsv_headers)
-            for worker in workers:
-                with open(worker.fout, 'r', encoding='utf8') as tsvin:
-                    reader = csv.DictReader(tsvin, delimiter='\t')
-                    for row in reader:
+            writer.writeheader()
+            for answers in csvutils.chunks(self._answers(), self.batch_size):
+                tags = self.tagger.index.bestAll(a[2] for a in answers)
+                for (artist, title, _), tag in zip(answers, tags):
+                    if tag:
                         writer.writerow(
-                            {'trackid': row['trackid'],
-                             'artist': row['artist'],
-                             'title': row['title'],
-                             'tag': row['tag']}
-                        )
-
-    def start(self):
-        self._setUp()
-        splits = csvutils.load(self.fin, splits=self.processes)
-        with tempfile.TemporaryDirectory() as tmpdir:
-            workers = self._createWorkers(tmpdir, splits)
-            self.log.info('starting workers')
-            for worker in workers:
-                worker.start()
-            self.log.info('waiting for workers...')
-            for worker in workers:
-                worker.join()
-            self._merge(workers)
-        self.log.info('tag job completed')
+                            {'artist': artist, 'title': title, 'tag': tag})
+                        rescored += 1
+        self.log.info('{:d} answers tagged'.format(rescored))
+        self.log.info('rescore job completed')
 
 
 class VectorizeJob():
@@ -179,10 +532,9 @@ class VectorizeJob():
     def _buildDataset(self):
         data = []
         labels = []
-        ftags_rows = csvutils.load(self.ftags)[0]
-        tags = {row['trackid']: row['tag'] for row in ftags_rows}
-        flyrics_rows = csvutils.load(self.flyrics)[0]
-        for row in flyrics_rows:
+        tags = {row['trackid']: row['tag']
+                for row in csvutils.stream(self.ftags)}
+        for row in csvutils.stream(self.flyrics):
             trackid = row['trackid']
             lyrics = row['lyrics']
             tag = tags.get(trackid, None)
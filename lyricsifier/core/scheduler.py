@@ -0,0 +1,213 @@
+import collections
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+from lyricsifier.core.utils import metrics
+
+
+class WorkerError(Exception):
+    pass
+
+
+class Scheduler:
+
+    # Workers ask for a batch of tracks whenever they have a free slot, so
+    # a worker stuck on a slow host does not hold back tracks the others
+    # could process. Each worker has its own pipe and the scheduler knows
+    # which batches it holds, so the batches of a crashed worker are
+    # requeued.
+    # The rows of a batch come back with its completion and are handed to
+    # collect, a batch that is requeued has not produced any row yet.
+    # A batch that crashed max_crashes workers is dropped, crashed builds
+    # the payload handed to collect in its place. Workers dying before
+    # they are done with any batch, max_crashes times in a row, are failing
+    # to start and the run is stopped with a WorkerError.
+    # On shutdown the stop event tells the workers to finish the tracks they
+    # are working on and to send back what they have, no batch is handed out
+    # anymore.
+
+    def __init__(self, createWorker, collect, processes=1, max_crashes=3,
+                 stop=None, crashed=None):
+        self.createWorker = createWorker
+        self.collect = collect
+        self.processes = processes
+        self.max_crashes = max_crashes
+        self.stop = stop or multiprocessing.Event()
+        self.crashed = crashed
+        self.stopping = False
+        self._wakeup = None
+        # worker ids are not reused by the following runs, their metrics
+        # are kept apart
+        self._spawned = 0
+        self.log = logging.getLogger(__name__)
+
+    def _spawn(self):
+        wid = 'w{:d}'.format(self._spawned)
+        self._spawned += 1
+        channel, child = multiprocessing.Pipe()
+        worker = self.createWorker(wid, child)
+        worker.start()
+        child.close()
+        self._channels[channel] = worker
+        self._assigned[wid] = {}
+        metrics.setGauge('lyricsifier_workers', len(self._channels))
+        self.log.info('worker {} started'.format(wid))
+
+    def _next(self):
+        if self._requeued:
+            return self._requeued.popleft()
+        task = next(self._batches, None)
+        if task is None:
+            self._exhausted = True
+        return task
+
+    def _send(self, channel, message):
+        # returns False if the worker is gone, its pipe is reaped once the
+        # messages it sent before dying are read
+        try:
+            channel.send(message)
+            return True
+        except OSError:
+            return False
+
+    def _release(self, channel):
+        if channel not in self._released:
+            self._released.add(channel)
+            self._send(channel, None)
+
+    def _dispatch(self, channel):
+        if self.stopping:
+            self._release(channel)
+            return
+        worker = self._channels[channel]
+        task = self._next()
+        if task is None:
+            self._idle.append(channel)
+            return
+        if self._send(channel, task):
+            self._assigned[worker.wid][task[0]] = task
+        else:
+            self._requeued.appendleft(task)
+
+    def _receive(self, channel):
+        # returns whether the worker has a free slot for a new batch
+        worker = self._channels[channel]
+        kind, bid, payload = channel.recv()
+        if kind == 'metrics':
+            metrics.update(worker.wid, payload)
+            return False
+        if kind == 'done':
+            del self._assigned[worker.wid][bid]
+            self._startFailures = 0
+            self.collect(payload)
+        return True
+
+    def _reap(self, channel):
+        # the pipe is closed once every message sent by the worker is read
+        worker = self._channels.pop(channel)
+        metrics.setGauge('lyricsifier_workers', len(self._channels))
+        self._idle = [c for c in self._idle if c is not channel]
+        channel.close()
+        worker.join()
+        self._released.discard(channel)
+        tasks = self._assigned.pop(worker.wid)
+        if not tasks and worker.exitcode == 0:
+            return
+        if self.stopping:
+            self.log.error('worker {} died while stopping with exit code {}'
+                           .format(worker.wid, worker.exitcode))
+            return
+        self.log.error('worker {} died with exit code {}'.format(
+            worker.wid, worker.exitcode))
+        metrics.inc('lyricsifier_worker_crashes_total')
+        if not tasks:
+            self._startFailures += 1
+            if self._startFailures >= self.max_crashes:
+                self.log.error('{:d} workers died without any batch - '
+                               'stopping'.format(self._startFailures))
+                self._error = WorkerError(
+                    'workers keep dying, last exit code {}'
+                    .format(worker.exitcode))
+                self._stop()
+                return
+        for bid, batch in tasks.values():
+            self._crashes[bid] += 1
+            if self._crashes[bid] >= self.max_crashes:
+                self.log.error('batch {:d} crashed {:d} workers - dropping {}'
+                               .format(bid, self._crashes[bid], batch))
+                if self.crashed:
+                    self.collect(self.crashed(
+                        batch, self._crashes[bid], worker.exitcode))
+            else:
+                self.log.warning('requeuing batch {:d}'.format(bid))
+                self._requeued.append((bid, batch))
+        while self._idle and self._requeued:
+            self._dispatch(self._idle.pop())
+        if self._requeued or not self._exhausted:
+            self._spawn()
+
+    def shutdown(self):
+        # may be called from a signal handler, the loop does the rest
+        if self._wakeup:
+            os.write(self._wakeup[1], b'\0')
+
+    def _wake(self):
+        os.read(self._wakeup[0], 512)
+        self._stop()
+
+    def _stop(self):
+        if self.stopping:
+            return
+        self.log.warning('stopping, waiting for the tracks in progress')
+        self.stopping = True
+        self.stop.set()
+        for channel in set(self._idle):
+            self._release(channel)
+        self._idle = []
+
+    def run(self, batches):
+        # batches are pulled lazily, one per free worker slot
+        self._batches = enumerate(batches)
+        self._exhausted = False
+        self._requeued = collections.deque()
+        self._crashes = collections.Counter()
+        self._startFailures = 0
+        self._error = None
+        self._channels = {}
+        self._assigned = {}
+        self._idle = []
+        self._released = set()
+        self._wakeup = os.pipe()
+        try:
+            self._loop()
+        finally:
+            wakeup, self._wakeup = self._wakeup, None
+            for fd in wakeup:
+                os.close(fd)
+        if self._error:
+            raise self._error
+
+    def _loop(self):
+        for _ in range(self.processes):
+            self._spawn()
+        while self._channels:
+            if self._exhausted and not any(self._assigned.values()) and \
+                    not self._requeued:
+                for channel in set(self._idle):
+                    self._release(channel)
+                self._idle = []
+            # an idle worker sends nothing, its pipe is ready only on exit
+            ready = multiprocessing.connection.wait(
+                list(self._channels) + [self._wakeup[0]])
+            if self._wakeup[0] in ready:
+                self._wake()
+                ready.remove(self._wakeup[0])
+            for channel in ready:
+                try:
+                    free = self._receive(channel)
+                except (EOFError, OSError):
+                    self._reap(channel)
+                    continue
+                if free:
+                    self._dispatch(channel)
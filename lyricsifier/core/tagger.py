@@ -1,10 +1,84 @@
+import concurrent.futures
+import functools
 import logging
 import json
+import re
+import threading
 import urllib.parse
 import urllib.request
 from abc import ABC, abstractmethod
 from unidecode import unidecode
-from lyricsifier.core.utils import connection
+from lyricsifier.core.utils import connection, tagcache
+
+
+@functools.lru_cache(maxsize=65536)
+def _normalize(name):
+    # the same few thousand tag names come back for every artist
+    return unidecode(name).lower()
+
+
+class GenreIndex:
+
+    # The genres hierarchy compiled into a map from every genre and subgenre
+    # name to its genre, so that scoring the tags of an answer takes a
+    # lookup per tag. A name listed under several genres belongs to the
+    # first of them. Names are indexed as written first, as tags used to be
+    # compared to them, and then normalized like tags are. With fuzzy, names
+    # also match when they differ only in spaces and punctuation, e.g.
+    # hip-hop, hip hop and hiphop.
+
+    __squash__ = re.compile(r'[^a-z0-9]+')
+
+    def __init__(self, genres, aliases=None, fuzzy=False):
+        self.genres = list(genres)
+        self.fuzzy = fuzzy
+        self._rank = {g: i for i, g in enumerate(self.genres)}
+        self._index = {}
+        self._squashed = {}
+        names = []
+        for genre in self.genres:
+            names.append((genre, genre))
+            names.extend((subgenre, genre) for subgenre in genres[genre])
+        names.extend((aliases or {}).items())
+        for name, genre in names:
+            self._index.setdefault(name, genre)
+        for name, genre in names:
+            name = _normalize(name)
+            self._index.setdefault(name, genre)
+            if fuzzy:
+                self._squashed.setdefault(self.__squash__.sub('', name), genre)
+
+    def __len__(self):
+        return len(self._index)
+
+    def genre(self, tag):
+        name = _normalize(tag)
+        genre = self._index.get(name)
+        if genre is None and self.fuzzy:
+            genre = self._squashed.get(self.__squash__.sub('', name))
+        return genre
+
+    def best(self, tags):
+        # the genre with the highest count, the first genre wins a tie and
+        # is also the answer when no tag is known, every genre counts zero
+        if not tags:
+            return None
+        scores = {}
+        for tag in tags:
+            genre = self.genre(tag['name'])
+            if genre is not None:
+                scores[genre] = scores.get(genre, 0) + int(tag['count'])
+        best = self.genres[0]
+        top = scores.get(best, 0)
+        for genre, score in scores.items():
+            if score > top or \
+                    score == top and self._rank[genre] < self._rank[best]:
+                best = genre
+                top = score
+        return best
+
+    def bestAll(self, tag_lists):
+        return [self.best(tags) for tags in tag_lists]
 
 
 class BaseTagger(ABC):
@@ -26,14 +100,16 @@ class BaseTagger(ABC):
 
 class LastFMTagger(BaseTagger):
 
-    def __init__(self, api_key, genres):
+    __not_found__ = 6
+
+    def __init__(self, api_key, genres, cache=None, aliases=None,
+                 fuzzy=False):
         BaseTagger.__init__(self)
         self.api_key = api_key
         self.base_url = "http://ws.audioscrobbler.com/2.0/"
         self.genres = genres
-
-    def _topGenres(self):
-        return {g: 0 for g in self.genres}
+        self.index = GenreIndex(genres, aliases=aliases, fuzzy=fuzzy)
+        self.cache = cache
 
     def _request(self, params):
         self.log.info(
@@ -50,21 +126,26 @@ class LastFMTagger(BaseTagger):
         error = json_data.get('error', None)
         if error:
             self.log.error(json_data['message'])
-            return None
+            # an unknown artist or track has no tags, any other error may
+            # not happen again
+            return [] if error == self.__not_found__ else None
         return json_data['toptags']['tag']
 
+    def _tags(self, params, *names):
+        if self.cache is None:
+            return self._parse(self._request(params))
+        key = tagcache.key(params['method'], *names)
+        cached, tags = self.cache.get(key)
+        if cached:
+            return tags
+        tags = self._parse(self._request(params))
+        if tags is not None:
+            tags = [{'name': t['name'], 'count': t['count']} for t in tags]
+            self.cache.put(key, tags)
+        return tags
+
     def _best(self, tags):
-        if not tags:
-            return None
-        topGenres = self._topGenres()
-        for tag in tags:
-            t = unidecode(tag['name']).lower()
-            c = int(tag['count'])
-            for g in topGenres:
-                if t == g or t in self.genres[g]:
-                    topGenres[g] += c
-                    break
-        return max(topGenres, key=lambda g: topGenres[g])
+        return self.index.best(tags)
 
     def tagArtist(self, artist):
         params = {
@@ -73,9 +154,7 @@ class LastFMTagger(BaseTagger):
             'api_key': self.api_key,
             'format': 'json'
         }
-        response = self._request(params)
-        tags = self._parse(response)
-        return self._best(tags)
+        return self._best(self._tags(params, artist))
 
     def tagTrack(self, artist, title):
         params = {
@@ -85,6 +164,50 @@ class LastFMTagger(BaseTagger):
             'api_key': self.api_key,
             'format': 'json'
         }
-        response = self._request(params)
-        tags = self._parse(response)
-        return self._best(tags)
+        return self._best(self._tags(params, artist, title))
+
+
+class ConcurrentTagger(BaseTagger):
+
+    # Lets the threads of a worker share a tagger: a call for an artist or
+    # track already in flight waits for that answer instead of asking
+    # again. Requests still go through the rate limiter of the connection.
+
+    def __init__(self, tagger):
+        BaseTagger.__init__(self)
+        self.tagger = tagger
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def __str__(self):
+        # retries and circuits stay keyed by the wrapped tagger
+        return str(self.tagger)
+
+    def _call(self, key, fn, *args):
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def tagArtist(self, artist):
+        return self._call(tagcache.key('artist.gettoptags', artist),
+                          self.tagger.tagArtist, artist)
+
+    def tagTrack(self, artist, title):
+        return self._call(tagcache.key('track.gettoptags', artist, title),
+                          self.tagger.tagTrack, artist, title)
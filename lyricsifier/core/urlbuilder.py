@@ -1,7 +1,13 @@
+import functools
 import logging
 import re
 from abc import ABC, abstractmethod
 from unidecode import unidecode
+from lyricsifier.core.utils import csv as csvutils
+
+
+# every builder transliterates the same artist and title of a track
+_ascii = functools.lru_cache(maxsize=4096)(unidecode)
 
 
 class BaseURLBuilder(ABC):
@@ -9,6 +15,8 @@ class BaseURLBuilder(ABC):
     def __init__(self, pattern):
         self.pattern = pattern
         self.log = logging.getLogger(__name__)
+        # an artist comes back for every one of its titles
+        self._artist = functools.lru_cache(maxsize=65536)(self._normalize)
 
     def __str__(self):
         return self.__class__.__name__
@@ -20,6 +28,9 @@ class BaseURLBuilder(ABC):
 
 class MetroLyricsURLBuilder(BaseURLBuilder):
 
+    __symbols__ = re.compile(r'[^a-zA-Z0-9\s-]')
+    __spaces__ = re.compile(r' +')
+
     def __init__(self):
         BaseURLBuilder.__init__(
             self,
@@ -27,19 +38,22 @@ class MetroLyricsURLBuilder(BaseURLBuilder):
         )
 
     def _normalize(self, string):
-        s = unidecode(string)
-        s = re.sub('[^a-zA-Z0-9\s-]', '', s)
-        s = re.sub(' +', '-', s)
+        s = _ascii(string)
+        s = self.__symbols__.sub('', s)
+        s = self.__spaces__.sub('-', s)
         return s.strip('-').lower()
 
     def build(self, artist, title):
-        a = self._normalize(artist)
+        a = self._artist(artist)
         t = self._normalize(title)
         return self.pattern.format(t, a)
 
 
 class LyricsComURLBuilder(BaseURLBuilder):
 
+    __symbols__ = re.compile(r'[^a-zA-Z0-9\s-]')
+    __spaces__ = re.compile(r' +')
+
     def __init__(self):
         BaseURLBuilder.__init__(
             self,
@@ -47,19 +61,24 @@ class LyricsComURLBuilder(BaseURLBuilder):
         )
 
     def _normalize(self, string):
-        s = unidecode(string)
-        s = re.sub('[^a-zA-Z0-9\s-]', '', s)
-        s = re.sub(' +', '-', s)
+        s = _ascii(string)
+        s = self.__symbols__.sub('', s)
+        s = self.__spaces__.sub('-', s)
         return s.strip('-').lower()
 
     def build(self, artist, title):
-        a = self._normalize(artist)
+        a = self._artist(artist)
         t = self._normalize(title)
         return self.pattern.format(t, a)
 
 
 class LyricsModeURLBuilder(BaseURLBuilder):
 
+    __separators__ = re.compile(r'[\.-/]')
+    __symbols__ = re.compile(r'[^a-zA-Z0-9\s_]')
+    __spaces__ = re.compile(r' +')
+    __underscores__ = re.compile(r'_+')
+
     def __init__(self):
         BaseURLBuilder.__init__(
             self,
@@ -67,22 +86,24 @@ class LyricsModeURLBuilder(BaseURLBuilder):
         )
 
     def _normalize(self, string):
-        s = unidecode(string)
-        s = re.sub('[\.-/]', '_', s)
-        s = re.sub('[^a-zA-Z0-9\s_]', '', s)
-        s = re.sub(' +', '_', s)
-        s = re.sub('_+', '_', s)
+        s = _ascii(string)
+        s = self.__separators__.sub('_', s)
+        s = self.__symbols__.sub('', s)
+        s = self.__spaces__.sub('_', s)
+        s = self.__underscores__.sub('_', s)
         return s.strip('_').lower()
 
     def build(self, artist, title):
-        a = self._normalize(artist)
+        a = self._artist(artist)
         t = self._normalize(title)
-        i = a[0] if len(a) > 0 and re.match('[a-z]', a[0]) else '0-9'
+        i = a[0] if len(a) > 0 and 'a' <= a[0] <= 'z' else '0-9'
         return self.pattern.format(i, a, t)
 
 
 class AZLyricsURLBuilder(BaseURLBuilder):
 
+    __symbols__ = re.compile(r'[^a-zA-Z0-9]')
+
     def __init__(self):
         BaseURLBuilder.__init__(
             self,
@@ -90,11 +111,39 @@ class AZLyricsURLBuilder(BaseURLBuilder):
         )
 
     def _normalize(self, string):
-        s = unidecode(string)
-        s = re.sub('[^a-zA-Z0-9]', '', s)
+        s = _ascii(string)
+        s = self.__symbols__.sub('', s)
         return s.lower()
 
     def build(self, artist, title):
-        a = self._normalize(artist)
+        a = self._artist(artist)
         t = self._normalize(title)
         return self.pattern.format(a, t)
+
+
+__builders__ = {
+    'metrolyrics': MetroLyricsURLBuilder,
+    'lyricscom': LyricsComURLBuilder,
+    'lyricsmode': LyricsModeURLBuilder,
+    'azlyrics': AZLyricsURLBuilder,
+}
+
+
+def buildURLs(fin, fout, sources, shard=0, shards=1):
+    # runs in a pool process, appends the urls of every shards-th track of
+    # fin to fout, returns how many were written; a track without trackid
+    # gets the index of its row in fin, counted from 0 after the header
+    builders = [(source, __builders__[source]()) for source in sources]
+    written = 0
+    with open(fout, 'a', encoding='utf8') as tsvout:
+        tracks = csvutils.stream(fin, shard=shard, shards=shards)
+        for i, track in enumerate(tracks):
+            trackid = track.get('trackid') or str(shard + i * shards)
+            artist = track['artist']
+            title = track['title']
+            tsvout.writelines(
+                '\t'.join((trackid, artist, title, source,
+                           builder.build(artist, title))) + '\n'
+                for source, builder in builders)
+            written += len(builders)
+    return written
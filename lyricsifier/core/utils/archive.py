@@ -0,0 +1,120 @@
+import csv
+import glob
+import gzip
+import logging
+import os
+import threading
+import time
+from lyricsifier.core.utils.csv import dropPartialRow
+
+log = logging.getLogger(__name__)
+
+
+# An archive is a directory of append-only segments, one per writer.
+# Each record of a segment is a separate gzip member holding a WARC-like
+# header block followed by the raw page, so that any record can be read
+# back on its own. The .idx file next to each segment maps trackids and
+# urls to the offset and length of their record, and to the time it was
+# stored at so that the latest record of a trackid wins whatever segment
+# holds it.
+
+
+class ArchiveWriter:
+
+    def __init__(self, directory, name):
+        os.makedirs(directory, exist_ok=True)
+        self.segment = os.path.join(directory, name + '.warc.gz')
+        self.index = os.path.join(directory, name + '.idx')
+        self._data = None
+        self._idx = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        # a row cut by a crash would run into the next one
+        if os.path.exists(self.index) and dropPartialRow(self.index):
+            log.warning('dropped a partial row of {}'.format(self.index))
+        self._data = open(self.segment, 'ab')
+        self._idx = open(self.index, 'a', encoding='utf8', newline='')
+        self._writer = csv.writer(self._idx, delimiter='\t')
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, trackid, url, html):
+        header = ('WARC/1.0\r\n'
+                  'WARC-Type: response\r\n'
+                  'WARC-Target-URI: {}\r\n'
+                  'WARC-Date: {}\r\n'
+                  'Lyricsifier-Trackid: {}\r\n'
+                  'Content-Length: {:d}\r\n\r\n'
+                  .format(url,
+                          time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                          trackid, len(html)))
+        record = gzip.compress(header.encode('utf8') + html + b'\r\n\r\n')
+        with self._lock:
+            offset = self._data.tell()
+            self._data.write(record)
+            self._data.flush()
+            # the index is written last, a record without index is ignored
+            self._writer.writerow(
+                [trackid, url, offset, len(record), repr(time.time())])
+            self._idx.flush()
+
+    def close(self):
+        if self._data:
+            self._data.close()
+            self._idx.close()
+            self._data = None
+            self._idx = None
+
+
+def _parseRecord(record):
+    header, _, body = record.partition(b'\r\n\r\n')
+    return body[:-4]
+
+
+def read(segment, offset, length):
+    with open(segment, 'rb') as f:
+        f.seek(offset)
+        return _parseRecord(gzip.decompress(f.read(length)))
+
+
+class ArchiveReader:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, '*.warc.gz')))
+
+    def entries(self):
+        # the latest record of each trackid wins, the rows of the indexes
+        # written before the time column count as the oldest
+        latest = {}
+        for segment in self.segments():
+            index = segment[:-len('.warc.gz')] + '.idx'
+            if not os.path.exists(index):
+                log.warning('no index for segment {}'.format(segment))
+                continue
+            size = os.path.getsize(segment)
+            with open(index, 'r', encoding='utf8', newline='') as idx:
+                # a row without its line end was cut while being written
+                lines = [line for line in idx if line.endswith('\n')]
+            for row in csv.reader(lines, delimiter='\t'):
+                if len(row) == 4:
+                    row.append('0')
+                if len(row) != 5:
+                    continue
+                trackid, url, offset, length, stored = row
+                if int(offset) + int(length) > size:
+                    continue
+                if trackid in latest and latest[trackid][0] > float(stored):
+                    continue
+                latest[trackid] = (float(stored), (trackid, url, segment,
+                                                   int(offset), int(length)))
+        return [entry for _, entry in latest.values()]
+
+    def __iter__(self):
+        for trackid, url, segment, offset, length in self.entries():
+            yield trackid, url, read(segment, offset, length)
@@ -1,10 +1,27 @@
+import contextlib
+import email.message
+import io
 import logging
 import http
+import http.client
+import os
+import sys
+import threading
+import time
+import urllib.parse
 import urllib.request
 import urllib.error
+import zlib
+from lyricsifier.core.utils import metrics
 
 log = logging.getLogger(__name__)
 __temporary_errors_codes__ = [408, 500, 503, 504]
+__redirect_codes__ = [301, 302, 303, 307, 308]
+__user_agent__ = 'Python-urllib/{:d}.{:d}'.format(*sys.version_info[:2])
+_cache = None
+_limiter = None
+_stats_lock = threading.Lock()
+_stats = {'requests': 0, 'wire_bytes': 0, 'decoded_bytes': 0}
 
 
 class SOFTConnError(Exception):
@@ -15,27 +32,313 @@ class FATALConnError(Exception):
     pass
 
 
+class Response:
+
+    def __init__(self, url, body, headers=None, code=200, wire_bytes=0):
+        self.url = url
+        self.body = body
+        self.code = code
+        self.wire_bytes = wire_bytes
+        self.decoded_bytes = len(body)
+        if isinstance(headers, email.message.Message):
+            self.headers = headers
+        else:
+            self.headers = email.message.Message()
+            for k, v in (headers or {}).items():
+                self.headers[k] = v
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.body
+
+
+class _Decoder:
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._zlib = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, data):
+        if self._first and self.encoding == 'deflate':
+            self._first = False
+            try:
+                return self._zlib.decompress(data)
+            except zlib.error:
+                # some servers send a raw deflate stream without zlib header
+                self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._zlib.decompress(data)
+
+    def flush(self):
+        return self._zlib.flush()
+
+
+def _readBody(resp, chunk_size=65536):
+    encoding = (resp.getheader('Content-Encoding') or '').strip().lower()
+    decoder = _Decoder(encoding) if encoding in ('gzip', 'deflate') else None
+    chunks = []
+    wire_bytes = 0
+    while True:
+        chunk = resp.read(chunk_size)
+        if not chunk:
+            break
+        wire_bytes += len(chunk)
+        chunks.append(decoder.decompress(chunk) if decoder else chunk)
+    if decoder:
+        chunks.append(decoder.flush())
+        del resp.msg['Content-Encoding']
+        del resp.msg['Content-Length']
+    return b''.join(chunks), wire_bytes
+
+
+def _throttle(host):
+    if _limiter:
+        _limiter.acquire(host)
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def _count(response, host):
+    with _stats_lock:
+        _stats['requests'] += 1
+        _stats['wire_bytes'] += response.wire_bytes
+        _stats['decoded_bytes'] += response.decoded_bytes
+    metrics.inc('lyricsifier_http_wire_bytes_total', response.wire_bytes,
+                host=host)
+    metrics.inc('lyricsifier_http_decoded_bytes_total',
+                response.decoded_bytes, host=host)
+    log.debug('received {:d} bytes ({:d} decoded) from {}'.format(
+        response.wire_bytes, response.decoded_bytes, response.geturl()))
+
+
+class ConnectionPool:
+
+    def __init__(self, max_size=8, idle_timeout=15, timeout=60,
+                 max_redirects=10, compress=True):
+        self.max_size = max_size
+        self.compress = compress
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+
+    def _connect(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(
+                host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def _acquire(self, key):
+        with self._lock:
+            if self._pid != os.getpid():
+                # sockets inherited from the parent process are not reused
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get(key, [])
+            now = time.monotonic()
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return conn, True
+                conn.close()
+        return self._connect(key), False
+
+    def _release(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if self._pid == os.getpid() and len(idle) < self.max_size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def _send(self, key, method, selector, headers, data):
+        conn, reused = self._acquire(key)
+        try:
+            conn.request(method, selector, body=data, headers=headers)
+            resp = conn.getresponse()
+            body, wire_bytes = _readBody(resp)
+        except (ConnectionError, http.client.BadStatusLine) as e:
+            conn.close()
+            if not reused:
+                raise
+            # the server closed an idle keep-alive connection
+            log.debug('reconnecting to {} - {}'.format(key[1], e))
+            return self._send(key, method, selector, headers, data)
+        except BaseException:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        return resp, body, wire_bytes
+
+    def urlopen(self, request):
+        url = request.full_url
+        method = request.get_method()
+        data = request.data
+        headers = {'User-Agent': __user_agent__}
+        if self.compress:
+            headers['Accept-Encoding'] = 'gzip, deflate'
+        for k, v in request.header_items():
+            headers[k.title()] = v
+        headers['Connection'] = 'keep-alive'
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            selector = urllib.parse.urlunsplit(
+                ('', '', parts.path or '/', parts.query, ''))
+            headers['Host'] = parts.netloc
+            _throttle(parts.hostname)
+            start = time.monotonic()
+            try:
+                resp, body, wire_bytes = self._send(
+                    key, method, selector, headers, data)
+            except (OSError, http.client.HTTPException, zlib.error) as e:
+                metrics.inc('lyricsifier_http_errors_total',
+                            host=parts.hostname)
+                raise urllib.error.URLError(e)
+            metrics.observe('lyricsifier_http_request_duration_seconds',
+                            time.monotonic() - start, host=parts.hostname)
+            metrics.inc('lyricsifier_http_responses_total',
+                        host=parts.hostname, code=resp.status)
+            if resp.status in __redirect_codes__ and \
+                    resp.getheader('Location'):
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                if resp.status == 303 or (resp.status in (301, 302) and
+                                          method == 'POST'):
+                    method = 'GET'
+                    data = None
+                continue
+            if resp.status >= 300:
+                raise urllib.error.HTTPError(
+                    url, resp.status, resp.reason, resp.msg, io.BytesIO(body))
+            response = Response(
+                url, body, resp.msg, resp.status, wire_bytes=wire_bytes)
+            _count(response, parts.hostname)
+            return response
+        raise urllib.error.HTTPError(
+            url, resp.status, 'too many redirects', resp.msg, None)
+
+
+_pool = ConnectionPool()
+
+
+def setPool(pool):
+    global _pool
+    _pool = pool
+
+
+def setRateLimiter(limiter):
+    global _limiter
+    _limiter = limiter
+    if limiter:
+        log.info('using rate limiter {}'.format(limiter))
+
+
+def setCache(cache):
+    global _cache
+    _cache = cache
+    if cache:
+        log.info('using http cache {}'.format(cache))
+
+
+def _cachedOpen(request, cache):
+    url = request.full_url
+    entry = cache.get(url)
+    if entry and cache.isFresh(entry):
+        response = cache.response(entry)
+        if response:
+            log.debug('cache hit for {}'.format(url))
+            metrics.inc('lyricsifier_http_cache_total', result='hit')
+            return response
+    conditional = cache.conditionalHeaders(entry) if entry else {}
+    for k, v in conditional.items():
+        request.add_header(k, v)
+    try:
+        response = _pool.urlopen(request)
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        log.debug('{} not modified'.format(url))
+        metrics.inc('lyricsifier_http_cache_total', result='revalidated')
+        cache.refresh(url, entry)
+        response = cache.response(entry)
+        if response:
+            return response
+        # the cached body has been evicted meanwhile
+        for k in conditional:
+            request.remove_header(k.capitalize())
+        response = _pool.urlopen(request)
+    finally:
+        for k in conditional:
+            request.remove_header(k.capitalize())
+    metrics.inc('lyricsifier_http_cache_total', result='miss')
+    cache.store(url, response, response.read())
+    return response
+
+
 def open(request):
+    # HTTPError is a subclass of URLError, so it must be handled first
     try:
-        return urllib.request.urlopen(request)
-    except (ConnectionError, http.client.IncompleteRead,
-            urllib.error.URLError) as e:
-        raise SOFTConnError(e)
+        if _cache and request.get_method() == 'GET':
+            return _cachedOpen(request, _cache)
+        return _pool.urlopen(request)
     except urllib.error.HTTPError as e:
         if e.code in __temporary_errors_codes__:
             raise SOFTConnError(e)
         else:
             raise FATALConnError(e)
+    except (ConnectionError, http.client.IncompleteRead,
+            urllib.error.URLError) as e:
+        raise SOFTConnError(e)
 
 
 def read(response):
     try:
         return response.read()
-    except (ConnectionError, http.client.IncompleteRead,
-            urllib.error.URLError) as e:
-        raise SOFTConnError(e)
     except urllib.error.HTTPError as e:
         if e.code in __temporary_errors_codes__:
             raise SOFTConnError(e)
         else:
             raise FATALConnError(e)
+    except (ConnectionError, http.client.IncompleteRead,
+            urllib.error.URLError) as e:
+        raise SOFTConnError(e)
+
+
+class HostLimiter:
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+    @contextlib.contextmanager
+    def acquire(self, host):
+        semaphore = self._semaphore(host)
+        with semaphore:
+            yield
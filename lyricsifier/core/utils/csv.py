@@ -1,22 +1,129 @@
 import csv
+import itertools
 import logging
+import os
 
 log = logging.getLogger(__name__)
 
 
-def load(file, splits=1):
-    content = []
+def stream(file, chunksize=None, shard=0, shards=1):
+    # yields the rows one at a time, or in lists of chunksize rows, without
+    # ever holding the whole file in memory; with shards > 1 only every
+    # shards-th row starting from shard is yielded
     with open(file, 'r', encoding='utf8') as tsvin:
         reader = csv.DictReader(tsvin, delimiter='\t', quoting=csv.QUOTE_NONE)
-        for row in reader:
-            dictionary = {}
-            for k in row:
-                dictionary[k] = row[k]
-            content.append(dictionary)
+        rows = itertools.islice(reader, shard, None, shards)
+        if chunksize:
+            rows = chunks(rows, chunksize)
+        yield from rows
+
+
+def header(file):
+    with open(file, 'r', encoding='utf8') as tsvin:
+        reader = csv.reader(tsvin, delimiter='\t', quoting=csv.QUOTE_NONE)
+        return next(reader, [])
+
+
+def chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load(file, splits=1):
     res = []
     for _ in range(splits):
         res.append([])
-    for i, dictionary in enumerate(content):
-        rr = i % splits
-        res[rr].append(dictionary)
+    for i, row in enumerate(stream(file)):
+        res[i % splits].append(row)
     return res
+
+
+def dropPartialRow(file):
+    # removes the last row if it was cut by a crash, returns the bytes removed
+    with open(file, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            step = min(65536, pos)
+            pos -= step
+            f.seek(pos)
+            i = f.read(step).rfind(b'\n')
+            if i >= 0:
+                f.truncate(pos + i + 1)
+                return end - pos - i - 1
+        f.truncate(0)
+        return end
+
+
+class IdSet:
+
+    # integer ids take a bit each in a bitmap as long as they are dense
+    # enough for the bitmap to take less memory than a set of them, any
+    # other id goes to a set
+
+    __max_bitmap_id__ = 2 ** 32
+    # bytes of bitmap allowed per id it holds, past a first megabyte
+    __bytes_per_id__ = 64
+    __min_bitmap__ = 2 ** 20
+
+    def __init__(self, ids=()):
+        self._bitmap = bytearray()
+        self._bits = 0
+        self._others = set()
+        self._len = 0
+        for id in ids:
+            self.add(id)
+
+    def _int(self, id):
+        try:
+            n = int(id)
+        except (TypeError, ValueError):
+            return None
+        if 0 <= n < self.__max_bitmap_id__ and str(n) == str(id):
+            return n
+        return None
+
+    def _grow(self, byte):
+        # returns whether the bitmap can hold byte without getting sparse
+        limit = max(self.__min_bitmap__,
+                    self.__bytes_per_id__ * (self._bits + 1))
+        if byte >= limit:
+            return False
+        size = min(max(byte + 1, 2 * len(self._bitmap)), limit)
+        self._bitmap.extend(bytes(size - len(self._bitmap)))
+        return True
+
+    def add(self, id):
+        n = self._int(id)
+        if n is not None:
+            byte, bit = divmod(n, 8)
+            if byte < len(self._bitmap) or self._grow(byte):
+                # an id may have gone to the set before the bitmap grew
+                if not self._bitmap[byte] & (1 << bit) and \
+                        id not in self._others:
+                    self._bitmap[byte] |= 1 << bit
+                    self._bits += 1
+                    self._len += 1
+                return
+        if id not in self._others:
+            self._others.add(id)
+            self._len += 1
+
+    def __contains__(self, id):
+        n = self._int(id)
+        if n is not None:
+            byte, bit = divmod(n, 8)
+            if byte < len(self._bitmap) and self._bitmap[byte] & (1 << bit):
+                return True
+        return id in self._others
+
+    def __len__(self):
+        return self._len
+
+
+def ids(file, column='trackid'):
+    return IdSet(row[column] for row in stream(file))
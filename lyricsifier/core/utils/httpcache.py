@@ -0,0 +1,168 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from lyricsifier.core.utils.connection import Response
+
+log = logging.getLogger(__name__)
+
+
+class HTTPCache:
+
+    def __init__(self, directory, ttl=None, max_size=None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._size = None
+        os.makedirs(os.path.join(directory, 'meta'), exist_ok=True)
+        os.makedirs(os.path.join(directory, 'data'), exist_ok=True)
+
+    def __str__(self):
+        return '{}({})'.format(self.__class__.__name__, self.directory)
+
+    def _path(self, kind, digest):
+        return os.path.join(self.directory, kind, digest[:2], digest)
+
+    def _metaPath(self, url):
+        return self._path('meta', hashlib.sha1(url.encode('utf8')).hexdigest())
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '{}.{:d}.{:d}.tmp'.format(
+            path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp, path)
+
+    def _entries(self):
+        for root, _, files in os.walk(os.path.join(self.directory, 'meta')):
+            for name in files:
+                if not name.endswith('.tmp'):
+                    yield os.path.join(root, name)
+
+    def _scanSize(self):
+        size = 0
+        for root, _, files in os.walk(os.path.join(self.directory, 'data')):
+            for name in files:
+                size += os.path.getsize(os.path.join(root, name))
+        return size
+
+    def get(self, url):
+        path = self._metaPath(url)
+        try:
+            with open(path, 'r', encoding='utf8') as fin:
+                entry = json.load(fin)
+            # the meta file mtime is the last access time used by the LRU
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def entries(self):
+        # every entry, read without touching its last access time
+        for path in self._entries():
+            try:
+                with open(path, 'r', encoding='utf8') as fin:
+                    yield json.load(fin)
+            except (OSError, ValueError):
+                continue
+
+    def isFresh(self, entry):
+        if self.ttl is None:
+            return True
+        return time.time() - entry['stored'] < self.ttl
+
+    def conditionalHeaders(self, entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def response(self, entry):
+        try:
+            with open(self._path('data', entry['digest']), 'rb') as fin:
+                body = fin.read()
+        except OSError:
+            return None
+        return Response(entry['final_url'], body, entry['headers'])
+
+    def refresh(self, url, entry):
+        entry['stored'] = time.time()
+        self._write(self._metaPath(url),
+                    json.dumps(entry).encode('utf8'))
+
+    def store(self, url, response, body):
+        digest = hashlib.sha256(body).hexdigest()
+        data_path = self._path('data', digest)
+        added = 0
+        if not os.path.exists(data_path):
+            self._write(data_path, body)
+            added = len(body)
+        headers = response.info()
+        entry = {
+            'url': url,
+            'final_url': response.geturl(),
+            'digest': digest,
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'headers': {k: v for k, v in headers.items()
+                        if k.lower() in ('content-type', 'etag',
+                                         'last-modified')},
+            'stored': time.time(),
+        }
+        self._write(self._metaPath(url), json.dumps(entry).encode('utf8'))
+        log.debug('cached {} as {}'.format(url, digest))
+        if self.max_size is not None:
+            self._grow(added)
+
+    def _grow(self, added):
+        with self._lock:
+            if self._size is None:
+                self._size = self._scanSize()
+            else:
+                self._size += added
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # evicts least recently used entries until the cache is down to 90%
+        # of its max size, body files are shared so they are only deleted
+        # once no remaining entry references them
+        entries = []
+        for path in self._entries():
+            try:
+                with open(path, 'r', encoding='utf8') as fin:
+                    digest = json.load(fin)['digest']
+                entries.append((os.path.getmtime(path), path, digest))
+            except (OSError, ValueError, KeyError):
+                continue
+        entries.sort()
+        refs = {}
+        for _, _, digest in entries:
+            refs[digest] = refs.get(digest, 0) + 1
+        target = self.max_size * 0.9
+        evicted = 0
+        for _, path, digest in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            evicted += 1
+            refs[digest] -= 1
+            if refs[digest] == 0:
+                data_path = self._path('data', digest)
+                try:
+                    self._size -= os.path.getsize(data_path)
+                    os.remove(data_path)
+                except OSError:
+                    pass
+        log.info('{} entries evicted from {}'.format(evicted, self))
@@ -0,0 +1,239 @@
+import http.server
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+__buckets__ = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+# Every process counts in its own Registry, workers send a snapshot of it to
+# the parent which keeps the latest one of each worker and exports the sum
+# in the Prometheus text format. Counters only grow, so the latest snapshot
+# of a worker is all that is needed even if some are lost.
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._values = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self._types.setdefault(name, 'counter')
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._types.setdefault(name, 'gauge')
+            self._values[_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        with self._lock:
+            self._types.setdefault(name, 'histogram')
+            values = self._values
+            for le in __buckets__ + ['+Inf']:
+                key = _key(name + '_bucket', dict(labels, le=le))
+                hit = le == '+Inf' or value <= le
+                values[key] = values.get(key, 0) + (1 if hit else 0)
+            key = _key(name + '_sum', labels)
+            values[key] = values.get(key, 0) + value
+            key = _key(name + '_count', labels)
+            values[key] = values.get(key, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._types = {}
+            self._values = {}
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._types), dict(self._values)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _family(name, types):
+    if name in types:
+        return name
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in types:
+            return name[:-len(suffix)]
+    return name
+
+
+class Aggregator:
+
+    def __init__(self, local):
+        self.local = local
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._snapshots = {}
+
+    def update(self, source, snapshot):
+        with self._lock:
+            self._snapshots[source] = snapshot
+
+    def reset(self):
+        with self._lock:
+            self._snapshots = {}
+
+    def render(self):
+        with self._lock:
+            snapshots = list(self._snapshots.values())
+        snapshots.append(self.local.snapshot())
+        types = {'lyricsifier_uptime_seconds': 'gauge'}
+        values = {('lyricsifier_uptime_seconds', ()):
+                  time.time() - self.started}
+        for t, v in snapshots:
+            types.update(t)
+            for key, value in v.items():
+                values[key] = values.get(key, 0) + value
+        families = {}
+        for (name, labels), value in values.items():
+            families.setdefault(_family(name, types), []).append(
+                (name, labels, value))
+        lines = []
+        for family in sorted(families):
+            lines.append('# TYPE {} {}'.format(
+                family, types.get(family, 'untyped')))
+            for name, labels, value in sorted(families[family],
+                                              key=_order):
+                if labels:
+                    name += '{' + ','.join(
+                        '{}="{}"'.format(k, _escape(v))
+                        for k, v in labels) + '}'
+                lines.append('{} {}'.format(name, _format(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _order(series):
+    # buckets are sorted by their numeric upper bound
+    name, labels, _ = series
+    labels = dict(labels)
+    le = float(labels.pop('le', 0))
+    return name, tuple(sorted(labels.items())), le
+
+
+def _format(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+_registry = Registry()
+_aggregator = Aggregator(_registry)
+
+
+def inc(name, value=1, **labels):
+    _registry.inc(name, value, **labels)
+
+
+def setGauge(name, value, **labels):
+    _registry.set(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    _registry.observe(name, value, **labels)
+
+
+def snapshot():
+    return _registry.snapshot()
+
+
+def reset():
+    # forked workers start from zero, their parent counts on its own
+    _registry.reset()
+    _aggregator.reset()
+
+
+def update(source, snapshot):
+    _aggregator.update(source, snapshot)
+
+
+def render():
+    return _aggregator.render()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Exporter:
+
+    def __init__(self, file=None, port=None, interval=15,
+                 host='127.0.0.1'):
+        self.file = file
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def write(self):
+        tmp = self.file + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            f.write(render())
+        os.replace(tmp, self.file)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                log.error('cannot write metrics - {}'.format(e))
+
+    def start(self):
+        if self.file:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+            log.info('writing metrics to {} every {} seconds'.format(
+                self.file, self.interval))
+        if self.port is not None:
+            self._server = http.server.ThreadingHTTPServer(
+                (self.host, self.port), _Handler)
+            threading.Thread(
+                target=self._server.serve_forever, daemon=True).start()
+            log.info('serving metrics on http://{}:{:d}/metrics'.format(
+                self.host, self._server.server_address[1]))
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self.write()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
@@ -1,4 +1,5 @@
 import re
+from unidecode import unidecode
 
 def encode(string):
     return string.encode('utf8', 'surrogateescape')
@@ -14,3 +15,64 @@ def inline(string, lower=False):
     s = re.sub('[\n\r\t]', ' ', string)
     s = re.sub(' +', ' ', s)
     return s.strip().lower() if lower else s.strip()
+
+
+class _Table(dict):
+
+    # a str.translate table filled on first use of each character, so the
+    # transliteration of a character is computed once per process
+
+    def __init__(self, lower):
+        dict.__init__(self)
+        self.lower = lower
+        for c in '\n\r\t':
+            self[ord(c)] = ' '
+        for i in range(128):
+            c = chr(i)
+            if c not in '\n\r\t':
+                self[i] = c.lower() if lower else c
+
+    def __missing__(self, key):
+        s = unidecode(chr(key))
+        s = s.replace('\n', ' ').replace('\r', ' ').replace('\t', ' ')
+        self[key] = s.lower() if self.lower else s
+        return self[key]
+
+
+class Normalizer:
+
+    # does in one str.translate what decode, unidecode and inline do in
+    # turn: transliteration, whitespace folding and lowercasing; the
+    # result is the same as inline(unidecode(decode(lyrics)), lower)
+
+    __spaces__ = re.compile(' {2,}')
+    __separator__ = '\x00'
+
+    def __init__(self, lower=True):
+        self.lower = lower
+        self._table = _Table(lower)
+
+    def _text(self, lyrics):
+        if isinstance(lyrics, bytes):
+            return lyrics.decode('utf8', 'replace')
+        return lyrics
+
+    def normalize(self, lyrics):
+        s = self._text(lyrics).translate(self._table)
+        return self.__spaces__.sub(' ', s).strip()
+
+    def normalizeAll(self, documents):
+        # one translate and one regex pass over all the documents joined
+        texts = [self._text(d) for d in documents]
+        sep = self.__separator__
+        joined = sep.join(texts)
+        if joined.count(sep) != len(texts) - 1:
+            return [self.normalize(t) for t in texts]
+        joined = self.__spaces__.sub(' ', joined.translate(self._table))
+        return [s.strip() for s in joined.split(sep)]
+
+
+_normalizer = Normalizer()
+
+def normalize(lyrics):
+    return _normalizer.normalize(lyrics)
@@ -0,0 +1,73 @@
+import logging
+import multiprocessing
+import time
+from lyricsifier.core.utils import metrics
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket:
+
+    # the bucket state lives in shared memory, so it must be created before
+    # the worker processes are forked in order to be shared with them
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, self.rate))
+        self._tokens = multiprocessing.Value('d', self.burst, lock=False)
+        self._updated = multiprocessing.Value('d', time.monotonic(),
+                                              lock=False)
+        self._lock = multiprocessing.Lock()
+
+    def __str__(self):
+        return '{}({:.2f}/s)'.format(self.__class__.__name__, self.rate)
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated.value
+            tokens = min(self.burst,
+                         self._tokens.value + elapsed * self.rate) - 1
+            self._tokens.value = tokens
+            self._updated.value = now
+        return 0 if tokens >= 0 else -tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+
+    def __init__(self, rates):
+        self.buckets = {host: TokenBucket(rate)
+                        for host, rate in rates.items()}
+
+    def __str__(self):
+        return '{}({})'.format(
+            self.__class__.__name__,
+            ', '.join('{}={}'.format(h, b) for h, b in self.buckets.items()))
+
+    def acquire(self, host):
+        bucket = self.buckets.get(host)
+        if not bucket:
+            return 0
+        wait = bucket.acquire()
+        if wait > 0:
+            log.debug('throttled {} for {:.3f} seconds'.format(host, wait))
+            metrics.inc('lyricsifier_ratelimit_wait_seconds_total', wait,
+                        host=host)
+        return wait
+
+
+def parse(specs):
+    rates = {}
+    for spec in specs:
+        host, sep, rate = spec.partition('=')
+        if not sep:
+            raise ValueError('invalid rate limit {} - HOST=RATE expected'
+                             .format(spec))
+        rates[host.strip()] = float(rate)
+    return rates
@@ -0,0 +1,142 @@
+import logging
+import random
+import threading
+import time
+from lyricsifier.core.utils import metrics
+from lyricsifier.core.utils.connection import SOFTConnError, FATALConnError
+
+log = logging.getLogger(__name__)
+
+
+class RetryError(Exception):
+
+    def __init__(self, reason, attempts):
+        Exception.__init__(
+            self, '{} - gave up after {:d} attempts'.format(reason, attempts))
+        self.reason = reason
+        self.attempts = attempts
+
+
+class CircuitOpenError(RetryError):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, threshold=5, cooldown=120):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._opened = {}
+        self._probing = set()
+
+    def allow(self, key):
+        with self._lock:
+            opened = self._opened.get(key)
+            if opened is None:
+                return True
+            if time.monotonic() - opened < self.cooldown or \
+                    key in self._probing:
+                return False
+            # half open, a single request probes the host
+            self._probing.add(key)
+            return True
+
+    def remaining(self, key):
+        # seconds left before the circuit lets a request through again
+        with self._lock:
+            opened = self._opened.get(key)
+            if opened is None:
+                return 0
+            return max(0, self.cooldown - (time.monotonic() - opened))
+
+    def success(self, key):
+        with self._lock:
+            if key in self._opened:
+                log.info('circuit for {} closed'.format(key))
+            self._failures.pop(key, None)
+            self._opened.pop(key, None)
+            self._probing.discard(key)
+
+    def failure(self, key):
+        with self._lock:
+            failures = self._failures.get(key, 0) + 1
+            self._failures[key] = failures
+            opened = self._opened.get(key)
+            expired = opened is not None and \
+                time.monotonic() - opened >= self.cooldown
+            if key in self._probing or expired or \
+                    failures == self.threshold:
+                log.warning(
+                    'circuit for {} opened for {} seconds'
+                    .format(key, self.cooldown))
+                metrics.inc('lyricsifier_circuit_opened_total', key=key)
+                self._opened[key] = time.monotonic()
+                self._probing.discard(key)
+
+
+class RetryPolicy:
+
+    def __init__(self, max_delay, base=1, cap=None, breaker=None,
+                 stop=None):
+        self.max_delay = max_delay
+        self.base = base
+        self.cap = cap or max(base, max_delay / 2)
+        self.breaker = breaker
+        self.stop = stop
+
+    def _sleep(self, key, secs):
+        # returns False if the stop event interrupted the sleep
+        log.warning('going to sleep for {:.1f} seconds'.format(secs))
+        metrics.inc('lyricsifier_backoff_seconds_total', secs, key=key)
+        if self.stop is None:
+            time.sleep(secs)
+            return True
+        return not self.stop.wait(secs)
+
+    def call(self, key, fn, *args):
+        # retries fn on soft errors with decorrelated jitter backoff until
+        # max_delay seconds have been spent sleeping for this call
+        breaker = self.breaker
+        if breaker and not breaker.allow(key):
+            raise CircuitOpenError('circuit open for {}'.format(key), 0)
+        attempts = 0
+        slept = 0
+        delay = self.base
+        while True:
+            attempts += 1
+            try:
+                result = fn(*args)
+            except SOFTConnError as e:
+                log.error(e)
+                if breaker:
+                    breaker.failure(key)
+                delay = min(self.cap, random.uniform(self.base, delay * 3))
+                # a call already retrying waits out an open circuit, as
+                # long as the cooldown fits in what is left of its budget
+                cooldown = breaker.remaining(key) if breaker else 0
+                if slept + max(delay, cooldown) > self.max_delay:
+                    metrics.inc('lyricsifier_retry_giveups_total', key=key)
+                    if cooldown:
+                        raise CircuitOpenError(e, attempts)
+                    raise RetryError(e, attempts)
+                delay = max(delay, cooldown)
+                metrics.inc('lyricsifier_retries_total', key=key)
+                if not self._sleep(key, delay):
+                    raise RetryError('{} - interrupted'.format(e), attempts)
+                slept += delay
+                continue
+            except FATALConnError as e:
+                log.error(e)
+                # the host did answer, the resource is just not there
+                if breaker:
+                    breaker.success(key)
+                raise RetryError(e, attempts)
+            except Exception:
+                if breaker:
+                    breaker.success(key)
+                raise
+            if breaker:
+                breaker.success(key)
+            return result
@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from lyricsifier.core.utils import metrics, normalization as nutils
+
+log = logging.getLogger(__name__)
+
+
+# The tags of the answers of a tagger, stored in a SQLite database in WAL
+# mode so that every worker process, and the following runs, read what any
+# of them stored. The raw tags are stored rather than the genre picked out
+# of them, a new genres file does not invalidate the cache. An empty list
+# of tags is a negative entry, it expires after negative_ttl seconds.
+
+
+def key(method, *names):
+    # artists and titles differing only in case, accents or spacing share
+    # the same entry
+    return '\t'.join([method] + [nutils.normalize(n) for n in names])
+
+
+class TagCache:
+
+    def __init__(self, path, ttl=2592000, negative_ttl=604800):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db().execute('CREATE TABLE IF NOT EXISTS tags ('
+                           'key TEXT PRIMARY KEY, '
+                           'tags TEXT NOT NULL, '
+                           'stored REAL NOT NULL)')
+
+    def __str__(self):
+        return '{}({})'.format(self.__class__.__name__, self.path)
+
+    def _db(self):
+        # a connection per thread, and a new one in a forked process
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            local.db = db
+            local.pid = os.getpid()
+        return local.db
+
+    def get(self, key):
+        # returns whether the key is cached and its tags
+        row = self._db().execute(
+            'SELECT tags, stored FROM tags WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            metrics.inc('lyricsifier_tag_cache_total', result='miss')
+            return False, None
+        tags = json.loads(row[0])
+        ttl = self.ttl if tags else self.negative_ttl
+        if ttl is not None and time.time() - row[1] >= ttl:
+            metrics.inc('lyricsifier_tag_cache_total', result='expired')
+            return False, None
+        metrics.inc('lyricsifier_tag_cache_total',
+                    result='hit' if tags else 'negative')
+        return True, tags
+
+    def put(self, key, tags):
+        self._db().execute(
+            'INSERT OR REPLACE INTO tags (key, tags, stored) VALUES (?, ?, ?)',
+            (key, json.dumps(tags or []), time.time()))
+        log.debug('cached {} tags for {}'.format(len(tags or []), key))
+
+    def close(self):
+        db = getattr(self._local, 'db', None)
+        if db is not None and self._local.pid == os.getpid():
+            db.close()
+        self._local = threading.local()
@@ -1,28 +1,201 @@
-import csv
+import collections
+import concurrent.futures
+import contextlib
 import logging
 import multiprocessing
-import time
-from lyricsifier.core.utils import normalization as nutils
-from lyricsifier.core.utils.connection import SOFTConnError, FATALConnError
-from unidecode import unidecode
+import os
+import queue
+import signal
+import threading
+import urllib.parse
+import zlib
+from lyricsifier.core.utils \
+    import connection, metrics, normalization as nutils, tagcache
+from lyricsifier.core.utils.archive import ArchiveWriter, read as readArchive
+from lyricsifier.core.utils.retry import \
+    CircuitBreaker, CircuitOpenError, RetryError, RetryPolicy
+
+
+class Failure:
+
+    # a track that produced no row, sent back with the rows of its batch so
+    # that the job records it in the dead-letter file; kind is one of soft,
+    # circuit, fatal, missing and unsupported, error for a track that
+    # raised an unexpected error, or crash for the tracks of a batch that
+    # kept crashing the workers
+
+    def __init__(self, track, kind, reason, attempts=0):
+        self.track = track
+        self.kind = kind
+        self.reason = reason
+        self.attempts = attempts
+
+    def record(self):
+        return dict(self.track,
+                    kind=self.kind,
+                    reason=' '.join(str(self.reason).split()),
+                    attempts=self.attempts)
 
 
 class BaseWorker(multiprocessing.Process):
 
-    def __init__(self, wid):
+    job = 'base'
+
+    def __init__(self, wid, channel, max_delay=500, io_concurrency=1,
+                 slots=1, stop=None):
         multiprocessing.Process.__init__(self, name=wid)
         self.wid = wid
+        self.channel = channel
+        self.max_delay = max_delay
+        self.io_concurrency = io_concurrency
+        self.slots = slots
+        self.stop = stop or multiprocessing.Event()
+        self.retry = RetryPolicy(max_delay, breaker=CircuitBreaker(),
+                                 stop=self.stop)
+        self.parent = os.getpid()
+        self.orphaned = False
         self.log = logging.getLogger(__name__)
 
-    def _sleep(self, secs):
-        self.log.warning(
-            'going to sleep for {:d} seconds'.format(secs))
-        time.sleep(secs)
+    def _context(self):
+        return contextlib.nullcontext()
 
-    def work(self):
+    def _process(self, track):
         pass
 
+    def _error(self, track, error):
+        return Failure(track, 'error',
+                       '{}: {}'.format(type(error).__name__, error))
+
+    def _guard(self, track):
+        # an error raised by a track fails that track only, the other tracks
+        # of its batch are not lost with the worker
+        try:
+            return self._process(track)
+        except Exception as e:
+            self.log.exception(e)
+            return self._error(track, e)
+
+    def _failure(self, track, error):
+        # a track given up because of the stop event is skipped, not failed
+        if self.stop.is_set():
+            return None
+        if isinstance(error, CircuitOpenError):
+            kind = 'circuit'
+        elif isinstance(error.reason, connection.FATALConnError):
+            kind = 'fatal'
+        else:
+            kind = 'soft'
+        return Failure(track, kind, error.reason, error.attempts)
+
+    def _orphan(self):
+        # the scheduler is gone, nobody collects the rows anymore so the
+        # worker stops like on a shutdown
+        if not self.orphaned:
+            self.log.error('lost the scheduler - stopping')
+            self.orphaned = True
+            self.stop.set()
+
+    def _receive(self, events):
+        try:
+            for task in iter(self.channel.recv, None):
+                events.put(task)
+        except (EOFError, OSError):
+            self._orphan()
+        events.put(None)
+
+    def _interrupt(self, batches):
+        self.log.warning('stopping, skipping the tracks not started yet')
+        for futures in batches.values():
+            for future in futures:
+                future.cancel()
+
+    def _send(self, bid, futures):
+        # cancelled and interrupted tracks are skipped, they are neither in
+        # the output nor in the dead-letter file and a resumed job will
+        # process them; _process may return a list for a group of tracks
+        results = []
+        for future in futures:
+            if future.cancelled():
+                results.append(None)
+                continue
+            result = future.result()
+            results.extend(result if isinstance(result, list) else [result])
+        rows = [r for r in results if isinstance(r, dict)]
+        failures = [r.record() for r in results if isinstance(r, Failure)]
+        if self.orphaned:
+            self.log.warning('dropping batch {:d} - no scheduler'.format(bid))
+            return
+        self.log.info('batch {:d} done - sending {:d} rows and {:d} failures'
+                      .format(bid, len(rows), len(failures)))
+        metrics.inc('lyricsifier_tracks_total', len(rows),
+                    job=self.job, result='ok')
+        metrics.inc('lyricsifier_tracks_total', len(failures),
+                    job=self.job, result='failed')
+        metrics.inc('lyricsifier_tracks_total',
+                    len(results) - len(rows) - len(failures),
+                    job=self.job, result='skipped')
+        self.channel.send(('metrics', None, metrics.snapshot()))
+        self.channel.send(('done', bid, (rows, failures)))
+
+    def work(self):
+        # batches are requested from the scheduler until the None sentinel
+        # and their tracks are processed by io_concurrency threads, the rows
+        # of a batch are sent back once the whole batch is done; only this
+        # thread sends, an error raised by a track fails that track only
+        events = queue.Queue()
+        threading.Thread(
+            target=self._receive, args=(events,), daemon=True).start()
+        batches = {}
+        with self._context(), concurrent.futures.ThreadPoolExecutor(
+                self.io_concurrency) as executor:
+            for _ in range(self.slots):
+                self.channel.send(('ready', None, None))
+            finished = False
+            interrupted = False
+            while not finished or batches:
+                # forked workers hold copies of the parent ends of the
+                # pipes, a dead parent does not always break them
+                if not finished and os.getppid() != self.parent:
+                    self._orphan()
+                    finished = True
+                if not interrupted and self.stop.is_set():
+                    interrupted = True
+                    self._interrupt(batches)
+                try:
+                    event = events.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if event is None:
+                    finished = True
+                elif isinstance(event, int):
+                    # every track of a batch signals, the first one that
+                    # finds the whole batch done sends it
+                    futures = batches.get(event)
+                    if not futures or not all(f.done() for f in futures):
+                        continue
+                    del batches[event]
+                    self._send(event, futures)
+                elif interrupted:
+                    self._send(event[0], [])
+                else:
+                    bid, tracks = event
+                    self.log.info('batch {:d} - {:d} tracks'
+                                  .format(bid, len(tracks)))
+                    batches[bid] = [executor.submit(self._guard, track)
+                                    for track in tracks]
+                    for future in batches[bid]:
+                        future.add_done_callback(
+                            lambda _, bid=bid: events.put(bid))
+            self.log.info('transfer stats: {}'.format(connection.stats()))
+            self.log.info('worker {} finished'.format(self.wid))
+
     def run(self):
+        # the parent handles the signals and stops the workers through the
+        # stop event, a Ctrl-C reaches the whole process group; a SIGTERM
+        # sent to a worker kills it, the scheduler requeues its batches
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        metrics.reset()
         try:
             self.work()
         except Exception as e:
@@ -32,133 +205,205 @@ class BaseWorker(multiprocessing.Process):
 
 class ExtractWorker(BaseWorker):
 
-    def __init__(self, wid, tracks, fout, extractors, max_delay=500):
-        BaseWorker.__init__(self, wid)
-        self.tracks = tracks
-        self.fout = fout
-        self.extractors = extractors
-        self.max_delay = max_delay
-        self.tsv_headers = ['trackid', 'lyrics']
+    job = 'extract'
+
+    def __init__(self, wid, channel, registry, max_delay=500,
+                 archive_dir=None, io_concurrency=1, slots=1, stop=None):
+        BaseWorker.__init__(self, wid, channel, max_delay=max_delay,
+                            io_concurrency=io_concurrency, slots=slots,
+                            stop=stop)
+        self.registry = registry
+        self.archive_dir = archive_dir
+        self.archive = None
 
     def _selectExtractor(self, url):
-        for extractor in self.extractors:
-            if extractor.canExtractFromURL(url):
-                return extractor
-        return None
+        return self.registry.select(url)
 
-    def _extract(self, url, extractor):
+    def _extract(self, trackid, url, extractor):
         self.log.info('extracting from {:s} with {}'.format(url, extractor))
-        delay = 1
-        while delay < self.max_delay:
-            try:
-                return extractor.extractFromURL(url)
-            except SOFTConnError as e:
-                self.log.error(e)
-                delay *= 2
-                self._sleep(delay)
-            except FATALConnError as e:
-                self.log.error(e)
-                return None
-        return None
+        host = urllib.parse.urlsplit(url).hostname
+        html = self.retry.call(host, extractor.fetch, url)
+        if self.archive:
+            self.archive.write(trackid, url, html)
+        return extractor.extractFromHTML(html)
 
-    def work(self):
-        with open(self.fout, 'w', encoding='utf8') as tsvout:
-            writer = csv.DictWriter(tsvout,
-                                    delimiter='\t',
-                                    fieldnames=self.tsv_headers)
-            writer.writeheader()
-            tot = len(self.tracks)
-            for i, track in enumerate(self.tracks):
-                self.log.info(
-                    'track {:d}/{:d} - {}'.format((i + 1), tot, track))
-                trackid = track['trackid']
-                url = track['url']
-                extractor = self._selectExtractor(url)
-                if not extractor:
-                    self.log.warning(
-                        'no extractor suitable for {:s} - skipping'
-                        .format(url))
-                    continue
-                lyrics = self._extract(url, extractor)
-                if lyrics:
-                    lyrics = nutils.inline(
-                        unidecode(nutils.decode(lyrics)), lower=True)
-                    self.log.debug(
-                        'lyrics normalized - {}'
-                        .format(lyrics))
-                    self.log.info('writing data to output file')
-                    writer.writerow(
-                        {'trackid': trackid,
-                         'lyrics': lyrics}
-                    )
-                else:
-                    self.log.warning(
-                        'cannot extract from {} - skipping'.format(url))
-            self.log.info('worker {} finished'.format(self.wid))
+    def _context(self):
+        if not self.archive_dir:
+            return contextlib.nullcontext()
+        self.archive = ArchiveWriter(self.archive_dir, self.wid)
+        return self.archive
+
+    def _process(self, track):
+        self.log.info('track {}'.format(track))
+        trackid = track['trackid']
+        url = track['url']
+        extractor = self._selectExtractor(url)
+        if not extractor:
+            self.log.warning(
+                'no extractor suitable for {:s} - skipping'.format(url))
+            return Failure(track, 'unsupported', 'no extractor suitable')
+        try:
+            lyrics = self._extract(trackid, url, extractor)
+        except RetryError as e:
+            self.log.error(e)
+            return self._failure(track, e)
+        if not lyrics:
+            self.log.warning('cannot extract from {} - skipping'.format(url))
+            return Failure(track, 'missing', 'no lyrics in the page', 1)
+        lyrics = nutils.normalize(lyrics)
+        self.log.debug('lyrics normalized - {}'.format(lyrics))
+        return {'trackid': trackid, 'lyrics': lyrics}
+
+
+_registry = None
+
+
+def initArchiveExtract(registry):
+    global _registry
+    _registry = registry
+
+
+def extractArchived(entry):
+    # runs in a pool process, extracts lyrics from an archived page; a
+    # damaged record is skipped rather than failing the whole pool
+    trackid, url, segment, offset, length = entry
+    extractor = _registry.select(url)
+    if not extractor:
+        return trackid, None
+    try:
+        html = readArchive(segment, offset, length)
+    except (OSError, EOFError, zlib.error) as e:
+        logging.getLogger(__name__).error(
+            'cannot read the record of track {} - {}'.format(trackid, e))
+        return trackid, None
+    try:
+        lyrics = extractor.extractFromHTML(html)
+    except Exception as e:
+        logging.getLogger(__name__).exception(e)
+        return trackid, None
+    return trackid, nutils.normalize(lyrics) if lyrics else None
 
 
 class TagWorker(BaseWorker):
 
-    def __init__(self, wid, tracks, fout, taggers, max_delay=500):
-        BaseWorker.__init__(self, wid)
-        self.tracks = tracks
-        self.fout = fout
+    job = 'tag'
+
+    # with granularity track a track is tagged by its own tags only, with
+    # track-then-artist by the tags of its artist when it has none
+
+    __granularities__ = ('artist', 'track', 'track-then-artist')
+    # the latest track lookups are kept, a track often comes again in the
+    # input but there are too many of them to keep them all
+    __cached_tracks__ = 4096
+
+    def __init__(self, wid, channel, taggers, max_delay=500,
+                 io_concurrency=1, slots=1, stop=None, by_artist=False,
+                 granularity='artist'):
+        BaseWorker.__init__(self, wid, channel, max_delay=max_delay,
+                            io_concurrency=io_concurrency, slots=slots,
+                            stop=stop)
+        if granularity not in self.__granularities__:
+            raise ValueError('unknown granularity {}'.format(granularity))
         self.taggers = taggers
-        self.max_delay = max_delay
-        self.tsv_headers = ['trackid', 'artist', 'title', 'tag']
+        self.by_artist = by_artist
+        self.granularity = granularity
         self.cached = {}
+        self.cached_tracks = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _tagTrack(self, artist, title, tagger):
+        key = str(tagger), tagcache.key('track.gettoptags', artist, title)
+        with self._lock:
+            if key in self.cached_tracks:
+                self.cached_tracks.move_to_end(key)
+                return self.cached_tracks[key]
+        tag = self.retry.call(str(tagger), tagger.tagTrack, artist, title)
+        with self._lock:
+            self.cached_tracks[key] = tag
+            if len(self.cached_tracks) > self.__cached_tracks__:
+                self.cached_tracks.popitem(last=False)
+        return tag
 
     def _tag(self, artist, title, tagger):
+        # artists are looked up once per worker, only the latest tracks are
+        # kept and the others are left to the tag cache
         self.log.info('getting tag for "{}"-"{}"'.format(artist, title))
         self.log.info('using tagger {}'.format(tagger))
-        delay = 1
-        while delay < self.max_delay:
+        if title is not None:
+            return self._tagTrack(artist, title, tagger)
+        key = str(tagger), tagcache.key('artist.gettoptags', artist)
+        if key in self.cached:
+            return self.cached[key]
+        tag = self.retry.call(str(tagger), tagger.tagArtist, artist)
+        self.cached[key] = tag
+        return tag
+
+    def _tagAll(self, artist, title):
+        # returns the first tag found and the error of the last tagger that
+        # could not answer
+        error = None
+        for tagger in self.taggers:
             try:
-                if artist in self.cached:
-                    return self.cached[artist]
-                else:
-                    tag = tagger.tagArtist(artist)
-                    self.cached[artist] = tag
-                    return tag
-            except SOFTConnError as e:
-                self.log.error(e)
-                delay *= 2
-                self._sleep(delay)
-            except FATALConnError as e:
+                tag = self._tag(artist, title, tagger)
+            except RetryError as e:
                 self.log.error(e)
-                return None
+                error = e
+                continue
+            if tag:
+                return tag, None
+        return None, error
 
-    def work(self):
-        with open(self.fout, 'w', encoding='utf8') as tsvout:
-            writer = csv.DictWriter(tsvout,
-                                    delimiter='\t',
-                                    fieldnames=self.tsv_headers)
-            writer.writeheader()
-            tot = len(self.tracks)
-            for i, track in enumerate(self.tracks):
-                self.log.info(
-                    'track {:d}/{:d} - {}'.format((i + 1), tot, track))
-                trackid = track['trackid']
-                artist = track['artist']
-                title = track['title']
-                tag = None
-                for tagger in self.taggers:
-                    tag = self._tag(artist, title, tagger)
-                    if tag:
-                        break
-                if tag:
-                    self.log.info(
-                        'track "{}"-"{}" tagged as {}'
-                        .format(artist, title, tag))
-                    self.log.info('writing data to output file')
-                    writer.writerow(
-                        {'trackid': trackid,
-                         'artist': artist,
-                         'title': title,
-                         'tag': tag}
-                    )
-                else:
-                    self.log.warning(
-                        'cannot tag "{}"-"{}" - skipping'
-                        .format(artist, title))
-            self.log.info('worker {} finished'.format(self.wid))
+    def _lookup(self, artist, title):
+        if self.granularity == 'artist':
+            tag, error = self._tagAll(artist, None)
+            level = 'artist'
+        else:
+            tag, error = self._tagAll(artist, title)
+            level = 'track'
+            if not tag and self.granularity == 'track-then-artist':
+                tag, fallback_error = self._tagAll(artist, None)
+                level = 'artist'
+                error = error or fallback_error
+        if tag:
+            metrics.inc('lyricsifier_tags_total', level=level)
+            return tag, None
+        return None, error
+
+    def _process(self, track):
+        if self.by_artist:
+            # a group of tracks of the same artist, tagged once unless they
+            # are tagged by their own tags
+            self.log.info('artist "{}" - {:d} tracks'.format(
+                track['artist'], len(track['tracks'])))
+            if self.granularity == 'artist':
+                tag, error = self._lookup(track['artist'], None)
+                return [self._result(t, tag, error) for t in track['tracks']]
+            return [self._result(t, *self._lookup(t['artist'], t['title']))
+                    for t in track['tracks']]
+        self.log.info('track {}'.format(track))
+        tag, error = self._lookup(track['artist'], track['title'])
+        return self._result(track, tag, error)
+
+    def _error(self, track, error):
+        if self.by_artist:
+            return [BaseWorker._error(self, t, error)
+                    for t in track['tracks']]
+        return BaseWorker._error(self, track, error)
+
+    def _result(self, track, tag, error):
+        trackid = track['trackid']
+        artist = track['artist']
+        title = track['title']
+        if not tag:
+            self.log.warning(
+                'cannot tag "{}"-"{}" - skipping'.format(artist, title))
+            # a tagger that could not answer may know the track
+            if error:
+                return self._failure(track, error)
+            return Failure(track, 'missing', 'no tag found')
+        self.log.info(
+            'track "{}"-"{}" tagged as {}'.format(artist, title, tag))
+        return {'trackid': trackid,
+                'artist': artist,
+                'title': title,
+                'tag': tag}
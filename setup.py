@@ -13,6 +13,7 @@ setup(
                       'nltk',
                       'sklearn',
                       'unidecode',],
+    extras_require={'lxml': ['lxml']},
     packages=find_packages(),
     include_package_data=True,
     zip_safe=False,
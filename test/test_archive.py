@@ -0,0 +1,88 @@
+import gzip
+import os
+import tempfile
+import unittest
+from lyricsifier.cli.utils import logging
+from lyricsifier.core.job import ArchiveExtractJob
+from lyricsifier.core.utils.archive import ArchiveReader, ArchiveWriter
+from lyricsifier.core.utils.archive import read
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testRoundTrip(self):
+        with ArchiveWriter(self.tmpdir.name, 'w0') as archive:
+            archive.write('1', 'http://a.com/1', b'<html>one</html>')
+            archive.write('2', 'http://a.com/2', b'<html>two</html>')
+        with ArchiveWriter(self.tmpdir.name, 'w1') as archive:
+            archive.write('1', 'http://a.com/1', b'<html>uno</html>')
+        pages = {trackid: (url, html)
+                 for trackid, url, html in ArchiveReader(self.tmpdir.name)}
+        self.assertEqual({'1': ('http://a.com/1', b'<html>uno</html>'),
+                          '2': ('http://a.com/2', b'<html>two</html>')}, pages)
+        # every record is a gzip member on its own
+        segment = os.path.join(self.tmpdir.name, 'w0.warc.gz')
+        with gzip.open(segment) as f:
+            self.assertIn(b'<html>two</html>', f.read())
+        with open(os.path.join(self.tmpdir.name, 'w0.idx')) as f:
+            offset, length = f.readlines()[1].split('\t')[2:4]
+        self.assertEqual(b'<html>two</html>',
+                         read(segment, int(offset), int(length)))
+
+    def testTruncatedSegment(self):
+        with ArchiveWriter(self.tmpdir.name, 'w0') as archive:
+            archive.write('1', 'http://a.com/1', b'<html>one</html>')
+            archive.write('2', 'http://a.com/2', b'<html>two</html>')
+        segment = os.path.join(self.tmpdir.name, 'w0.warc.gz')
+        with open(segment, 'r+b') as f:
+            f.truncate(os.path.getsize(segment) - 5)
+        trackids = [e[0] for e in ArchiveReader(self.tmpdir.name).entries()]
+        self.assertEqual(['1'], trackids)
+
+    def testLatestRecord(self):
+        # w10 sorts before w2, the time of the records decides
+        with ArchiveWriter(self.tmpdir.name, 'w2') as archive:
+            archive.write('1', 'http://a.com/1', b'<html>one</html>')
+        with ArchiveWriter(self.tmpdir.name, 'w10') as archive:
+            archive.write('1', 'http://a.com/1', b'<html>uno</html>')
+        self.assertEqual([('1', 'http://a.com/1', b'<html>uno</html>')],
+                         list(ArchiveReader(self.tmpdir.name)))
+
+    def testPartialIndexRow(self):
+        with ArchiveWriter(self.tmpdir.name, 'w0') as archive:
+            archive.write('1', 'http://a.com/1', b'<html>one</html>')
+            archive.write('2', 'http://a.com/2', b'<html>two</html>')
+        index = os.path.join(self.tmpdir.name, 'w0.idx')
+        with open(index, 'r+b') as f:
+            f.truncate(os.path.getsize(index) - 4)
+        trackids = [e[0] for e in ArchiveReader(self.tmpdir.name).entries()]
+        self.assertEqual(['1'], trackids)
+        # the next writer does not append to the partial row
+        with ArchiveWriter(self.tmpdir.name, 'w0') as archive:
+            archive.write('3', 'http://a.com/3', b'<html>three</html>')
+        trackids = [e[0] for e in ArchiveReader(self.tmpdir.name).entries()]
+        self.assertEqual(['1', '3'], sorted(trackids))
+
+    def testDamagedRecord(self):
+        with open('test/pages/metrolyrics.html', 'rb') as f:
+            html = f.read()
+        url = 'http://www.metrolyrics.com/{}-lyrics-artist.html'
+        with ArchiveWriter(self.tmpdir.name, 'w0') as archive:
+            for trackid in ('1', '2', '3'):
+                archive.write(trackid, url.format(trackid), html)
+        entries = {e[0]: e for e in ArchiveReader(self.tmpdir.name).entries()}
+        with open(entries['2'][2], 'r+b') as f:
+            f.seek(entries['2'][3] + 20)
+            f.write(b'\0' * 20)
+        fout = os.path.join(self.tmpdir.name, 'lyrics.tsv')
+        ArchiveExtractJob(self.tmpdir.name, fout, processes=2).start()
+        with open(fout, 'r', encoding='utf8') as f:
+            trackids = [line.split('\t')[0] for line in f][1:]
+        self.assertEqual(['1', '3'], sorted(trackids))
@@ -0,0 +1,237 @@
+import http.server
+import multiprocessing
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+import zlib
+from lyricsifier.cli.utils import logging
+from lyricsifier.core.utils import connection, ratelimit
+from lyricsifier.core.utils.connection import ConnectionPool
+from lyricsifier.core.utils.connection import SOFTConnError, FATALConnError
+from lyricsifier.core.utils.httpcache import HTTPCache
+from lyricsifier.core.utils.ratelimit import TokenBucket
+from lyricsifier.core.utils.retry import \
+    CircuitBreaker, CircuitOpenError, RetryError, RetryPolicy
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    requests = []
+    clients = set()
+    body = b'<html><body>' + b'lyrics ' * 1000 + b'</body></html>'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        _Handler.requests.append((self.path, dict(self.headers)))
+        _Handler.clients.add(self.client_address)
+        if self.path == '/page':
+            if self.headers.get('If-None-Match') == '"v1"':
+                return self._send(304)
+            return self._send(200, self.body, {'ETag': '"v1"'})
+        if self.path == '/gzip' and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+            body = compressor.compress(self.body) + compressor.flush()
+            return self._send(200, body, {'Content-Encoding': 'gzip'})
+        if self.path == '/deflate':
+            compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+            body = compressor.compress(self.body) + compressor.flush()
+            return self._send(200, body, {'Content-Encoding': 'deflate'})
+        if self.path == '/redirect':
+            return self._send(301, headers={'Location': '/page'})
+        if self.path.startswith('/big'):
+            return self._send(200, self.path.encode('utf8') * 2000)
+        return self._send(404)
+
+
+class TestConnection(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), _Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = 'http://127.0.0.1:{:d}'.format(
+            cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        _Handler.requests = []
+        _Handler.clients = set()
+
+    def tearDown(self):
+        connection.setCache(None)
+        connection.setPool(ConnectionPool())
+        self.tmpdir.cleanup()
+
+    def _get(self, path):
+        request = urllib.request.Request(self.base_url + path)
+        response = connection.open(request)
+        return response.geturl(), connection.read(response)
+
+    def testOpen(self):
+        url, body = self._get('/page')
+        self.assertEqual(self.base_url + '/page', url)
+        self.assertEqual(_Handler.body, body)
+        url, body = self._get('/redirect')
+        self.assertEqual(self.base_url + '/page', url)
+        with self.assertRaises(FATALConnError):
+            self._get('/missing')
+
+    def testKeepAlive(self):
+        for _ in range(5):
+            self._get('/page')
+        self._get('/redirect')
+        self.assertEqual(7, len(_Handler.requests))
+        self.assertEqual(1, len(_Handler.clients))
+
+    def testReconnect(self):
+        self._get('/page')
+        # the server drops the idle connection, the pool must reconnect
+        for conns in connection._pool._idle.values():
+            for conn, _ in conns:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(_Handler.body, self._get('/page')[1])
+        self.assertEqual(2, len(_Handler.clients))
+
+    def testCompression(self):
+        for path in ['/gzip', '/deflate']:
+            request = urllib.request.Request(self.base_url + path)
+            response = connection.open(request)
+            self.assertEqual(_Handler.body, connection.read(response))
+            self.assertEqual(len(_Handler.body), response.decoded_bytes)
+            self.assertLess(response.wire_bytes, response.decoded_bytes)
+            self.assertIsNone(response.info()['Content-Encoding'])
+        self.assertIn('gzip', _Handler.requests[0][1]['Accept-Encoding'])
+
+    def testCacheHit(self):
+        connection.setCache(HTTPCache(self.tmpdir.name))
+        first = self._get('/redirect')
+        second = self._get('/redirect')
+        self.assertEqual(first, second)
+        self.assertEqual(self.base_url + '/page', second[0])
+        self.assertEqual(2, len(_Handler.requests))
+
+    def testCacheRevalidation(self):
+        connection.setCache(HTTPCache(self.tmpdir.name, ttl=0))
+        first = self._get('/page')
+        second = self._get('/page')
+        self.assertEqual(first, second)
+        self.assertEqual(2, len(_Handler.requests))
+        self.assertNotIn('If-None-Match', _Handler.requests[0][1])
+        self.assertEqual('"v1"', _Handler.requests[1][1]['If-None-Match'])
+
+    def testCacheEviction(self):
+        cache = HTTPCache(self.tmpdir.name, max_size=50000)
+        connection.setCache(cache)
+        for i in range(10):
+            self._get('/big{:d}'.format(i))
+            time.sleep(0.01)
+        self.assertLessEqual(cache._scanSize(), 50000)
+        self.assertIsNone(cache.get(self.base_url + '/big0'))
+        self.assertIsNotNone(cache.get(self.base_url + '/big9'))
+
+
+def _consume(bucket, n):
+    for _ in range(n):
+        bucket.acquire()
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+
+    def testSharedBucket(self):
+        bucket = TokenBucket(20, burst=1)
+        processes = [multiprocessing.Process(target=_consume,
+                                             args=(bucket, 10))
+                     for _ in range(2)]
+        start = time.monotonic()
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        elapsed = time.monotonic() - start
+        # 20 tokens at 20 tokens/s with a single token burst
+        self.assertGreaterEqual(elapsed, 0.9)
+        self.assertLess(elapsed, 2)
+
+    def testParse(self):
+        rates = ratelimit.parse(['ws.audioscrobbler.com=5',
+                                 'www.azlyrics.com=0.5'])
+        self.assertEqual({'ws.audioscrobbler.com': 5.0,
+                          'www.azlyrics.com': 0.5}, rates)
+        with self.assertRaises(ValueError):
+            ratelimit.parse(['www.azlyrics.com'])
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.calls = 0
+
+    def _fail(self, error):
+        self.calls += 1
+        raise error('failure {:d}'.format(self.calls))
+
+    def _flaky(self):
+        self.calls += 1
+        if self.calls < 3:
+            raise SOFTConnError('flaky')
+        return 'ok'
+
+    def testRetry(self):
+        policy = RetryPolicy(0.05, base=0.001)
+        self.assertEqual('ok', policy.call('host', self._flaky))
+        self.assertEqual(3, self.calls)
+        self.calls = 0
+        with self.assertRaises(RetryError) as cm:
+            policy.call('host', self._fail, FATALConnError)
+        self.assertEqual(1, cm.exception.attempts)
+        self.calls = 0
+        with self.assertRaises(RetryError) as cm:
+            policy.call('host', self._fail, SOFTConnError)
+        self.assertEqual(self.calls, cm.exception.attempts)
+        self.assertGreater(self.calls, 1)
+
+    def testCircuitBreaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=0.1)
+        policy = RetryPolicy(0.05, base=0.001, breaker=breaker)
+        with self.assertRaises(CircuitOpenError):
+            policy.call('down', self._fail, SOFTConnError)
+        self.assertEqual(2, self.calls)
+        with self.assertRaises(CircuitOpenError) as cm:
+            policy.call('down', self._fail, SOFTConnError)
+        self.assertEqual(0, cm.exception.attempts)
+        self.assertEqual(2, self.calls)
+        self.assertEqual('ok', policy.call('up', lambda: 'ok'))
+        time.sleep(0.1)
+        self.assertEqual('ok', policy.call('down', lambda: 'ok'))
+        # a call with budget enough waits the circuit out and goes on
+        self.calls = 0
+        breaker = CircuitBreaker(threshold=2, cooldown=0.1)
+        policy = RetryPolicy(1, base=0.001, breaker=breaker)
+        self.assertEqual('ok', policy.call('flaky', self._flaky))
+        self.assertEqual(3, self.calls)
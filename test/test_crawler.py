@@ -0,0 +1,131 @@
+import csv
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import unittest
+from lyricsifier.core.crawler import MetroLyricsCrawler
+from lyricsifier.core.utils.connection import SOFTConnError
+from lyricsifier.cli.utils import logging
+
+
+class _Site:
+    # a stubbed metrolyrics, two indexes of two artists pages each, every
+    # artist has one or two songs pages; past the last page the site
+    # redirects to its home page like the real one
+
+    base_url = 'http://www.metrolyrics.com'
+
+    def __init__(self, outage=0, latency=0):
+        self.outage = outage
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def _table(self, cls, rows):
+        return '<html><table class="{}"><tbody>{}</tbody></table></html>' \
+            .format(cls, ''.join(rows)).encode('utf8')
+
+    def _page(self, url):
+        path = url[len(self.base_url):]
+        m = re.match(r'/artists-([ab])-([12])\.html$', path)
+        if m:
+            rows = ['<tr><td><a href="{}/{}{}{:d}-lyrics.html">'
+                    'Artist {}{}{:d} Lyrics</a></td></tr>'
+                    .format(self.base_url, m.group(1), m.group(2), i,
+                            m.group(1), m.group(2), i)
+                    for i in range(3)]
+            return self._table('songs-table', rows)
+        m = re.match(r'/(\w\d(\d))-alpage-(\d)\.html$', path)
+        if m and int(m.group(3)) <= 1 + int(m.group(2)) % 2:
+            rows = ['<tr><td class="n">{:d}</td><td><a href="{}/{}-{}-{:d}'
+                    '-lyrics.html">Song {:d} Lyrics</a></td></tr>'
+                    .format(j, self.base_url, m.group(1), m.group(3), j, j)
+                    for j in range(3)]
+            return self._table('songs-table compact', rows)
+        return None
+
+    def fetch(self, request):
+        url = request.full_url
+        with self.lock:
+            self.requests += 1
+            if self.requests <= self.outage:
+                raise SOFTConnError('503 Service Unavailable {}'.format(url))
+        time.sleep(random.uniform(0, self.latency))
+        page = self._page(url)
+        if page is None:
+            return self.base_url + '/', b'<html>home</html>'
+        return url, page
+
+
+class TestCrawler(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _crawler(self, name, site, **kwargs):
+        crawler = MetroLyricsCrawler(
+            os.path.join(self.tmpdir.name, name), 5, **kwargs)
+        crawler.artists_index = ['a', 'b']
+        crawler.retry.base = 0.001
+        crawler.retry.cap = 0.01
+        crawler._fetch = site.fetch
+        return crawler
+
+    def _rows(self, crawler):
+        with open(crawler.fout, 'r', encoding='utf8') as f:
+            return list(csv.DictReader(f, delimiter='\t'))
+
+    def testTransientOutage(self):
+        crawler = self._crawler('tracks.tsv', _Site())
+        crawler.crawl()
+        rows = self._rows(crawler)
+        self.assertEqual(48, len(rows))
+        # the pages failing for a while are retried, nothing is skipped
+        for concurrency in (1, 4):
+            crawler = self._crawler('outage.tsv', _Site(outage=6),
+                                    concurrency=concurrency)
+            crawler.crawl()
+            self.assertEqual(rows, self._rows(crawler))
+
+    def testResume(self):
+        crawler = self._crawler('tracks.tsv', _Site())
+        crawler.crawl()
+        rows = self._rows(crawler)
+        for crash_at, partial in ((1, '1'), (5, 'ht'), (9, '1\thttp://')):
+            crawler = self._crawler('resumed.tsv', _Site(), concurrency=4)
+            writes = []
+
+            def crash(rows, writes=writes, fout=crawler.fout):
+                # a crash in the middle of a row, after the checkpoint of
+                # the previous ones
+                writes.append(rows)
+                if len(writes) > crash_at:
+                    with open(fout, 'a', encoding='utf8') as f:
+                        f.write(partial)
+                    raise KeyboardInterrupt()
+                batchWrite(rows)
+
+            batchWrite = crawler._batchWrite
+            crawler._batchWrite = crash
+            with self.assertRaises(KeyboardInterrupt):
+                crawler.crawl()
+            crawler = self._crawler('resumed.tsv', _Site(), resume=True)
+            crawler.crawl()
+            self.assertEqual(rows, self._rows(crawler))
+
+    def testConcurrency(self):
+        # pages answered in any order make up the same output
+        serial = self._crawler('serial.tsv', _Site(latency=0.01))
+        serial.crawl()
+        site = _Site(latency=0.01)
+        concurrent = self._crawler('concurrent.tsv', site, concurrency=8)
+        concurrent.crawl()
+        self.assertEqual(self._rows(serial), self._rows(concurrent))
+        self.assertEqual(48, len(self._rows(concurrent)))
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+from lyricsifier.core.utils import csv as csvutils
+
+
+class TestCSV(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.tmpdir.name, 'tracks.tsv')
+        with open(self.file, 'w', encoding='utf8') as f:
+            f.write('trackid\turl\n')
+            for i in range(10):
+                f.write('{:d}\thttp://a.com/{:d}\n'.format(i, i))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testStream(self):
+        rows = list(csvutils.stream(self.file))
+        self.assertEqual(10, len(rows))
+        self.assertEqual({'trackid': '0', 'url': 'http://a.com/0'}, rows[0])
+        chunks = list(csvutils.stream(self.file, chunksize=4))
+        self.assertEqual([4, 4, 2], [len(chunk) for chunk in chunks])
+        self.assertEqual(rows, [row for chunk in chunks for row in chunk])
+
+    def testShards(self):
+        splits = csvutils.load(self.file, splits=3)
+        for shard in range(3):
+            self.assertEqual(
+                splits[shard],
+                list(csvutils.stream(self.file, shard=shard, shards=3)))
+
+    def testDropPartialRow(self):
+        with open(self.file, 'a', encoding='utf8') as f:
+            f.write('10\thttp://a.co')
+        self.assertEqual(14, csvutils.dropPartialRow(self.file))
+        self.assertEqual(0, csvutils.dropPartialRow(self.file))
+        self.assertEqual(10, len(list(csvutils.stream(self.file))))
+
+    def testIdSet(self):
+        ids = csvutils.ids(self.file)
+        self.assertEqual(10, len(ids))
+        self.assertIn('9', ids)
+        self.assertNotIn('10', ids)
+        self.assertNotIn('09', ids)
+        ids.add('TRAAAAW128F429D538')
+        ids.add('9')
+        self.assertIn('TRAAAAW128F429D538', ids)
+        self.assertEqual(11, len(ids))
+        self.assertLess(len(ids._bitmap), 8)
+        # a few sparse ids do not blow up the bitmap
+        ids.add(str(2 ** 32 - 1))
+        ids.add(str(2 ** 24))
+        self.assertIn(str(2 ** 32 - 1), ids)
+        self.assertIn(str(2 ** 24), ids)
+        self.assertNotIn(str(2 ** 24 + 1), ids)
+        self.assertLessEqual(len(ids._bitmap), 2 ** 20)
+        # the ids set aside are still found once the bitmap covers them
+        for i in range(2 ** 20):
+            ids.add(str(i))
+        ids.add(str(2 ** 24 + 8))
+        self.assertGreater(len(ids._bitmap), 2 ** 21)
+        self.assertIn(str(2 ** 24), ids)
+        ids.add(str(2 ** 24))
+        self.assertEqual(2 ** 20 + 4, len(ids))
@@ -1,8 +1,11 @@
+import importlib.util
+import os
 import unittest
 from lyricsifier.cli.utils import logging
 from lyricsifier.core.extractor \
-    import MetroLyricsExtractor, LyricsComExtractor, \
+    import ExtractorRegistry, MetroLyricsExtractor, LyricsComExtractor, \
     LyricsModeExtractor, AZLyricsExtractor, URLError
+from lyricsifier.core.job import ExtractJob
 
 
 class TestExtractors(unittest.TestCase):
@@ -89,3 +92,82 @@ class TestExtractors(unittest.TestCase):
         for url in fail_urls:
             with self.assertRaises(URLError):
                 extractor.extractFromURL(url)
+
+
+class TestExtractorRegistry(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.extractors = [MetroLyricsExtractor(), LyricsComExtractor(),
+                           LyricsModeExtractor(), AZLyricsExtractor(), ]
+        self.registry = ExtractorRegistry(self.extractors)
+
+    def testSelect(self):
+        urls = [
+            'http://www.metrolyrics.com/no-one-lyrics-alicia-keys.html',
+            'http://www.lyrics.com/no-one-lyrics-alicia-keys.html',
+            'http://www.lyricsmode.com/lyrics/a/alicia_keys/no_one.html',
+            'http://www.azlyrics.com/lyrics/aliciakeys/noone.html',
+        ]
+        for url, extractor in zip(urls, self.extractors):
+            self.assertIs(extractor, self.registry.select(url))
+
+    def testReject(self):
+        urls = [
+            'http://anothersite.com/no-one-lyrics-alicia-keys.html',
+            'http://www.metrolyrics.com/asdflaerjd.html',
+            'http://www.azlyrics.com/lyrics/no-one-lyrics-alicia-keys.html',
+            'not an url',
+        ]
+        for url in urls:
+            self.assertIsNone(self.registry.select(url))
+
+
+class TestFastParsing(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.pages = {
+            'metrolyrics.html': MetroLyricsExtractor(),
+            'lyricscom.html': LyricsComExtractor(),
+            'lyricsmode.html': LyricsModeExtractor(),
+            'azlyrics.html': AZLyricsExtractor(),
+        }
+        self.pagesdir = os.path.join(os.path.dirname(__file__), 'pages')
+
+    def _load(self, page):
+        with open(os.path.join(self.pagesdir, page), 'rb') as f:
+            return f.read()
+
+    def _parity(self, parser):
+        for page, extractor in self.pages.items():
+            html = self._load(page)
+            extractor.useParser('html.parser', fast=False)
+            expected = extractor.extractFromHTML(html)
+            self.assertTrue(expected)
+            for fast in (True, False):
+                extractor.useParser(parser, fast=fast)
+                self.assertEqual(parser, extractor.parser)
+                self.assertEqual(expected, extractor.extractFromHTML(html))
+
+    def testParity(self):
+        self._parity('html.parser')
+
+    @unittest.skipUnless(importlib.util.find_spec('lxml'),
+                         'lxml is not installed, see the lxml extra')
+    def testParityLxml(self):
+        self._parity('lxml')
+
+    def testNoLyrics(self):
+        html = b'<html><body><div>no lyrics here</div></body></html>'
+        for extractor in self.pages.values():
+            for fast in (True, False):
+                extractor.useParser('html.parser', fast=fast)
+                self.assertIsNone(extractor.extractFromHTML(html))
+
+    def testJobParser(self):
+        # a job configures its own extractors, not the shared ones
+        job = ExtractJob('tracks.tsv', 'lyrics.tsv', parser='lxml')
+        self.assertEqual({'lxml'}, {e.parser for e in job.registry})
+        self.assertEqual({'html.parser'},
+                         {e.parser for e in ExtractJob.__extractors__})
@@ -0,0 +1,96 @@
+import json
+import os
+import random
+import tempfile
+import time
+import unittest
+from unidecode import unidecode
+from lyricsifier.core.job import RescoreJob
+from lyricsifier.core.tagger import GenreIndex, LastFMTagger
+from lyricsifier.core.utils.connection import Response
+from lyricsifier.core.utils.httpcache import HTTPCache
+from lyricsifier.cli.utils import logging
+
+
+def _best(genres, tags):
+    # the scoring of the tagger before the index
+    if not tags:
+        return None
+    topGenres = {g: 0 for g in genres}
+    for tag in tags:
+        t = unidecode(tag['name']).lower()
+        c = int(tag['count'])
+        for g in topGenres:
+            if t == g or t in genres[g]:
+                topGenres[g] += c
+                break
+    return max(topGenres, key=lambda g: topGenres[g])
+
+
+class TestGenreIndex(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        with open('genres.json', 'r', encoding='utf8') as f:
+            self.genres = {g['genre']: g['subgenres'] for g in json.load(f)}
+
+    def _tags(self, rnd):
+        names = list(self.genres) + \
+            [s for subs in self.genres.values() for s in subs] + \
+            ['seen live', 'female vocalists', '90s', 'Rock', 'HIP HOP']
+        return [{'name': rnd.choice(names), 'count': rnd.choice([0, 5, 50])}
+                for _ in range(rnd.randint(0, 6))]
+
+    def testSameAsBefore(self):
+        rnd = random.Random(0)
+        index = GenreIndex(self.genres)
+        answers = [self._tags(rnd) for _ in range(5000)]
+        for tags in answers:
+            self.assertEqual(_best(self.genres, tags), index.best(tags))
+        # a subgenre of two genres belongs to the first one
+        self.assertEqual('african', index.genre('bongo flava'))
+        start = time.perf_counter()
+        for tags in answers:
+            _best(self.genres, tags)
+        before = time.perf_counter() - start
+        start = time.perf_counter()
+        index.bestAll(answers)
+        after = time.perf_counter() - start
+        print('\nscoring {:d} answers: {:.3f}s before, {:.3f}s with the '
+              'index'.format(len(answers), before, after))
+
+    def testFuzzyAndAliases(self):
+        index = GenreIndex(self.genres)
+        self.assertIsNone(index.genre('Hip-Hop'))
+        index = GenreIndex(self.genres, aliases={'rnb': 'r&b'}, fuzzy=True)
+        self.assertEqual('hip hop', index.genre('Hip-Hop'))
+        self.assertEqual('hip hop', index.genre('hiphop'))
+        self.assertEqual('r&b', index.genre('RnB'))
+        self.assertEqual('rock', index.genre('Neue Deutsche Härte'))
+        self.assertEqual('r&b', index.best([{'name': 'rnb', 'count': 10},
+                                            {'name': 'pop', 'count': 5}]))
+
+    def testRescore(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        cache = HTTPCache(os.path.join(tmpdir.name, 'cache'))
+        tagger = LastFMTagger('key', self.genres)
+        answers = {
+            'artist.gettoptags&artist=AC%2FDC': {'toptags': {'tag': [
+                {'name': 'hard rock', 'count': 100}]}},
+            'track.gettoptags&artist=Cher&track=Believe': {'toptags': {
+                'tag': [{'name': 'dance-pop', 'count': 100}]}},
+            'artist.gettoptags&artist=Nobody': {'error': 6,
+                                                'message': 'not found'},
+        }
+        for query, answer in answers.items():
+            url = tagger.base_url + '?method=' + query
+            body = json.dumps(answer).encode('utf8')
+            cache.store(url, Response(url, body), body)
+        cache.store('http://www.lyrics.com/x', Response('x', b'x'), b'x')
+        fout = os.path.join(tmpdir.name, 'rescored.tsv')
+        RescoreJob(cache.directory, fout, tagger).start()
+        with open(fout, 'r', encoding='utf8') as f:
+            rows = sorted(f.read().splitlines())
+        self.assertEqual(['AC/DC\t\trock', 'Cher\tBelieve\telectronic',
+                          'artist\ttitle\ttag'], rows)
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+from lyricsifier.core.utils import metrics
+from lyricsifier.core.utils.metrics import Exporter, Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        metrics.reset()
+        self.tmpdir.cleanup()
+
+    def testRender(self):
+        metrics.inc('test_requests_total', host='a', code=200)
+        metrics.observe('test_duration_seconds', 0.3, host='a')
+        worker = Registry()
+        worker.inc('test_requests_total', 2, host='a', code=200)
+        worker.inc('test_backoff_seconds_total', 1.5, key='a"b')
+        metrics.update('w0', worker.snapshot())
+        # a newer snapshot of the same worker replaces the previous one
+        worker.inc('test_requests_total', 1, host='a', code=200)
+        metrics.update('w0', worker.snapshot())
+        lines = metrics.render().splitlines()
+        self.assertIn('# TYPE test_requests_total counter', lines)
+        self.assertIn('test_requests_total{code="200",host="a"} 4', lines)
+        self.assertIn('test_backoff_seconds_total{key="a\\"b"} 1.5', lines)
+        self.assertIn('# TYPE test_duration_seconds histogram', lines)
+        self.assertIn('test_duration_seconds_bucket{host="a",le="0.25"} 0',
+                      lines)
+        self.assertIn('test_duration_seconds_bucket{host="a",le="+Inf"} 1',
+                      lines)
+        self.assertIn('test_duration_seconds_count{host="a"} 1', lines)
+        buckets = [line for line in lines if '_bucket' in line]
+        self.assertTrue(buckets[-1].startswith(
+            'test_duration_seconds_bucket{host="a",le="+Inf"}'))
+
+    def testExporter(self):
+        file = os.path.join(self.tmpdir.name, 'metrics.prom')
+        metrics.inc('test_requests_total')
+        with Exporter(file=file, port=0, interval=60) as exporter:
+            url = 'http://127.0.0.1:{:d}/metrics'.format(
+                exporter._server.server_address[1])
+            with urllib.request.urlopen(url) as response:
+                self.assertIn(b'test_requests_total 1', response.read())
+        with open(file, 'r', encoding='utf8') as f:
+            self.assertIn('test_requests_total 1', f.read())
@@ -0,0 +1,60 @@
+import os
+import random
+import timeit
+import unittest
+from unidecode import unidecode
+from lyricsifier.core.extractor \
+    import MetroLyricsExtractor, LyricsComExtractor, LyricsModeExtractor, \
+    AZLyricsExtractor
+from lyricsifier.core.utils import normalization as nutils
+from lyricsifier.core.utils.normalization import Normalizer
+
+
+def _chain(lyrics):
+    return nutils.inline(unidecode(nutils.decode(lyrics)), lower=True)
+
+
+class TestNormalization(unittest.TestCase):
+
+    def setUp(self):
+        pages = os.path.join(os.path.dirname(__file__), 'pages')
+        extractors = {'metrolyrics': MetroLyricsExtractor(),
+                      'lyricscom': LyricsComExtractor(),
+                      'lyricsmode': LyricsModeExtractor(),
+                      'azlyrics': AZLyricsExtractor()}
+        self.lyrics = []
+        for page, extractor in extractors.items():
+            with open(os.path.join(pages, page + '.html'), 'rb') as f:
+                self.lyrics.append(extractor.extractFromHTML(f.read()))
+        rnd = random.Random(42)
+        alphabet = 'aZ09 \n\r\t\x0b.,\'éÆßœ北亰ü 　ﬁǄ'
+        for _ in range(200):
+            text = ''.join(rnd.choice(alphabet)
+                           for _ in range(rnd.randint(0, 60)))
+            self.lyrics.append(nutils.encode(text))
+        self.lyrics.append(b'\xff\xfe invalid utf8')
+
+    def testParity(self):
+        normalizer = Normalizer()
+        for lyrics in self.lyrics:
+            self.assertEqual(_chain(lyrics), normalizer.normalize(lyrics))
+            self.assertEqual(_chain(lyrics), nutils.normalize(lyrics))
+        self.assertEqual([_chain(lyrics) for lyrics in self.lyrics],
+                         normalizer.normalizeAll(self.lyrics))
+        self.assertEqual('a\x00b', normalizer.normalizeAll(['A\x00B'])[0])
+        self.assertEqual(nutils.inline(unidecode('Ça  Va\n')),
+                         Normalizer(lower=False).normalize('Ça  Va\n'))
+
+    def testBenchmark(self):
+        print()
+        documents = self.lyrics[:4] * 250
+        normalizer = Normalizer()
+        chain = timeit.timeit(
+            lambda: [_chain(d) for d in documents], number=5)
+        single = timeit.timeit(
+            lambda: [normalizer.normalize(d) for d in documents], number=5)
+        batch = timeit.timeit(
+            lambda: normalizer.normalizeAll(documents), number=5)
+        print('decode+unidecode+inline: {:.3f}s'.format(chain))
+        print('normalize: {:.3f}s ({:.1f}x)'.format(single, chain / single))
+        print('normalizeAll: {:.3f}s ({:.1f}x)'.format(batch, chain / batch))
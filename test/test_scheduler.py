@@ -0,0 +1,256 @@
+import csv
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+from lyricsifier.cli.utils import logging
+from lyricsifier.core.job import QueueJob
+from lyricsifier.core.scheduler import WorkerError
+from lyricsifier.core.utils import metrics
+from lyricsifier.core.worker import BaseWorker, Failure
+
+
+class _Worker(BaseWorker):
+
+    def __init__(self, wid, channel, crash_file, io_concurrency, slots,
+                 stop, max_delay=500):
+        BaseWorker.__init__(self, wid, channel, max_delay=max_delay,
+                            io_concurrency=io_concurrency, slots=slots,
+                            stop=stop)
+        self.crash_file = crash_file
+
+    def _process(self, track):
+        if track['trackid'] == '7':
+            # crashes once, or every time without a crash file
+            if self.crash_file is None:
+                os._exit(1)
+            if not os.path.exists(self.crash_file):
+                open(self.crash_file, 'w').close()
+                os._exit(1)
+        if track['trackid'] == '5' and self.crash_file is None:
+            raise ValueError('unexpected page')
+        if track['trackid'] == '3':
+            # a slow track must not hold back the tracks after it
+            time.sleep(0.5)
+        if self.io_concurrency > 1:
+            time.sleep(0.1)
+        if track['trackid'] == '11' and self.max_delay < 1:
+            return Failure(track, 'soft', 'HTTP Error 503:\tunavailable', 2)
+        if track['trackid'] == '12' and self.max_delay != 500:
+            return Failure(track, 'fatal', 'HTTP Error 404: Not Found', 1)
+        return {'trackid': track['trackid'], 'wid': self.wid}
+
+
+class _BrokenWorker(_Worker):
+
+    def _context(self):
+        raise OSError('cannot set up the worker')
+
+
+class _Job(QueueJob):
+
+    def __init__(self, fin, fout, crash_file, processes, io_concurrency=1,
+                 resume=False, max_delay=500, defer_delay=None,
+                 retry_failed=False):
+        QueueJob.__init__(self, fin, fout, processes=processes, batch_size=2,
+                          io_concurrency=io_concurrency, resume=resume,
+                          max_delay=max_delay, defer_delay=defer_delay,
+                          retry_failed=retry_failed)
+        self.crash_file = crash_file
+        self.tsv_headers = ['trackid', 'wid']
+
+    def _createWorker(self, wid, channel):
+        return _Worker(wid, channel, self.crash_file,
+                       self.io_concurrency, self.slots, self.stop,
+                       max_delay=self.delay)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fin = os.path.join(self.tmpdir.name, 'tracks.tsv')
+        self.fout = os.path.join(self.tmpdir.name, 'out.tsv')
+        with open(self.fin, 'w', encoding='utf8') as f:
+            f.write('trackid\n')
+            for i in range(40):
+                f.write('{:d}\n'.format(i))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _rows(self, fout=None):
+        with open(fout or self.fout, 'r', encoding='utf8') as f:
+            return list(csv.DictReader(f, delimiter='\t'))
+
+    def testWorkStealing(self):
+        _Job(self.fin, self.fout, self.fin, processes=3).start()
+        rows = self._rows()
+        self.assertEqual(sorted(str(i) for i in range(40)),
+                         sorted(row['trackid'] for row in rows))
+        slow = [row['wid'] for row in rows if row['trackid'] == '3'][0]
+        self.assertLess(
+            len([row for row in rows if row['wid'] == slow]), 40 / 3)
+
+    def testCrashedWorker(self):
+        crash_file = os.path.join(self.tmpdir.name, 'crashed')
+        _Job(self.fin, self.fout, crash_file, processes=2).start()
+        self.assertTrue(os.path.exists(crash_file))
+        trackids = [row['trackid'] for row in self._rows()]
+        # the batch of the crashed worker is requeued, nothing is duplicated
+        self.assertEqual(sorted(str(i) for i in range(40)), sorted(trackids))
+
+    def testCrashingBatch(self):
+        ffailed = os.path.join(self.tmpdir.name, 'out.failed.tsv')
+        job = _Job(self.fin, self.fout, None, processes=2)
+        job.start()
+        # the batch crashing every worker it is given to ends up failed, a
+        # track raising an error fails without the rest of its batch
+        self.assertEqual(3, job.failed)
+        failed = sorted(self._rows(ffailed), key=lambda row: row['trackid'])
+        self.assertEqual(
+            [('5', 'error', '0', 'ValueError: unexpected page'),
+             ('6', 'crash', '3', 'crashed 3 workers - last exit code 1'),
+             ('7', 'crash', '3', 'crashed 3 workers - last exit code 1')],
+            [(row['trackid'], row['kind'], row['attempts'], row['reason'])
+             for row in failed])
+        self.assertEqual(
+            sorted(str(i) for i in range(40) if i not in (5, 6, 7)),
+            sorted(row['trackid'] for row in self._rows()))
+
+    def testBrokenWorkers(self):
+        job = _Job(self.fin, self.fout, None, processes=2)
+        job._createWorker = lambda wid, channel: _BrokenWorker(
+            wid, channel, None, 1, job.slots, job.stop)
+        start = time.monotonic()
+        # workers that cannot start are not respawned forever
+        with self.assertRaises(WorkerError):
+            job.start()
+        self.assertLess(time.monotonic() - start, 5)
+        # two workers, and one more for each of the first two that died
+        self.assertEqual(4, job.scheduler._spawned)
+
+    def testIOConcurrency(self):
+        crash_file = os.path.join(self.tmpdir.name, 'crashed')
+        start = time.monotonic()
+        _Job(self.fin, self.fout, crash_file, processes=1,
+             io_concurrency=8).start()
+        elapsed = time.monotonic() - start
+        trackids = [row['trackid'] for row in self._rows()]
+        self.assertEqual(sorted(str(i) for i in range(40)), sorted(trackids))
+        # 40 tracks of 0.1 seconds, 8 at a time, plus a crash
+        self.assertLess(elapsed, 2)
+
+    def testResume(self):
+        with open(self.fout, 'w', encoding='utf8') as f:
+            f.write('trackid\twid\n')
+            for i in range(0, 40, 3):
+                f.write('{:d}\told\n'.format(i))
+            f.write('39\tol')
+        _Job(self.fin, self.fout, self.fin, processes=2, resume=True).start()
+        rows = self._rows()
+        self.assertEqual(sorted(str(i) for i in range(40)),
+                         sorted(row['trackid'] for row in rows))
+        self.assertEqual(14, len([row for row in rows if row['wid'] == 'old']))
+
+    def testShutdown(self):
+        crash_file = os.path.join(self.tmpdir.name, 'crashed')
+        open(crash_file, 'w').close()
+        job = _Job(self.fin, self.fout, crash_file, processes=2,
+                   io_concurrency=2)
+        threading.Timer(
+            0.3, os.kill, args=(os.getpid(), signal.SIGTERM)).start()
+        start = time.monotonic()
+        job.start()
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertTrue(job.stopped)
+        trackids = [row['trackid'] for row in self._rows()]
+        self.assertLess(0, len(trackids))
+        self.assertLess(len(trackids), 40)
+        self.assertEqual(len(trackids), len(set(trackids)))
+        # what was completed before the signal is kept
+        job = _Job(self.fin, self.fout, crash_file, processes=2,
+                   io_concurrency=2, resume=True)
+        job.start()
+        self.assertFalse(job.stopped)
+        trackids = [row['trackid'] for row in self._rows()]
+        self.assertEqual(sorted(str(i) for i in range(40)), sorted(trackids))
+
+    def testTerminatedWorker(self):
+        crash_file = os.path.join(self.tmpdir.name, 'crashed')
+        open(crash_file, 'w').close()
+        job = _Job(self.fin, self.fout, crash_file, processes=2)
+        workers = []
+        createWorker = job._createWorker
+
+        def create(wid, channel):
+            workers.append(createWorker(wid, channel))
+            return workers[-1]
+
+        job._createWorker = create
+        threading.Timer(
+            0.2, lambda: [w.terminate() for w in workers[:2]]).start()
+        job.start()
+        # a terminated worker dies, its batches are requeued
+        self.assertEqual([-signal.SIGTERM] * 2,
+                         [w.exitcode for w in workers[:2]])
+        self.assertEqual(sorted(str(i) for i in range(40)),
+                         sorted(row['trackid'] for row in self._rows()))
+
+    def testDeadLetter(self):
+        crash_file = os.path.join(self.tmpdir.name, 'crashed')
+        open(crash_file, 'w').close()
+        ffailed = os.path.join(self.tmpdir.name, 'out.failed.tsv')
+        job = _Job(self.fin, self.fout, crash_file, processes=2, max_delay=0)
+        job.start()
+        self.assertEqual(2, job.failed)
+        failed = sorted(self._rows(ffailed), key=lambda row: row['trackid'])
+        self.assertEqual(
+            [{'trackid': '11', 'kind': 'soft', 'attempts': '2',
+              'reason': 'HTTP Error 503: unavailable'},
+             {'trackid': '12', 'kind': 'fatal', 'attempts': '1',
+              'reason': 'HTTP Error 404: Not Found'}], failed)
+        self.assertEqual(38, len(self._rows()))
+        # a resumed job does not retry the failed tracks
+        _Job(self.fin, self.fout, crash_file, processes=2,
+             resume=True).start()
+        self.assertEqual(38, len(self._rows()))
+        _Job(self.fin, self.fout, crash_file, processes=2, max_delay=100,
+             retry_failed=True).start()
+        self.assertEqual(sorted(str(i) for i in range(40) if i != 12),
+                         sorted(row['trackid'] for row in self._rows()))
+        self.assertEqual(['12'],
+                         [row['trackid'] for row in self._rows(ffailed)])
+        self.assertEqual(['crashed', 'out.failed.tsv', 'out.tsv',
+                          'tracks.tsv'], sorted(os.listdir(self.tmpdir.name)))
+        # nothing to retry once no track failed
+        os.remove(ffailed)
+        _Job(self.fin, self.fout, crash_file, processes=2,
+             retry_failed=True).start()
+        self.assertFalse(os.path.exists(ffailed))
+
+    def testDeferredRetry(self):
+        crash_file = os.path.join(self.tmpdir.name, 'crashed')
+        open(crash_file, 'w').close()
+        ffailed = os.path.join(self.tmpdir.name, 'out.failed.tsv')
+        metrics.reset()
+        _Job(self.fin, self.fout, crash_file, processes=2, max_delay=100,
+             defer_delay=0).start()
+        # the transient failure is retried once the other tracks are done
+        rows = self._rows()
+        self.assertEqual(sorted(str(i) for i in range(40) if i != 12),
+                         sorted(row['trackid'] for row in rows))
+        self.assertEqual('11', rows[-1]['trackid'])
+        self.assertEqual(['12'],
+                         [row['trackid'] for row in self._rows(ffailed)])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir.name, 'out.deferred.tsv')))
+        # the workers of both passes are counted
+        lines = metrics.render().splitlines()
+        self.assertIn('lyricsifier_tracks_total{job="base",result="ok"} 39',
+                      lines)
+        self.assertIn(
+            'lyricsifier_tracks_total{job="base",result="failed"} 2', lines)
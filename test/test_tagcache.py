@@ -0,0 +1,96 @@
+import io
+import json
+import multiprocessing
+import os
+import tempfile
+import unittest
+from lyricsifier.core.tagger import LastFMTagger
+from lyricsifier.core.utils import tagcache
+from lyricsifier.core.utils.tagcache import TagCache
+from lyricsifier.cli.utils import logging
+
+
+def _store(path, key, tags):
+    TagCache(path).put(key, tags)
+
+
+class _Tagger(LastFMTagger):
+
+    def __init__(self, genres, cache, answers):
+        LastFMTagger.__init__(self, 'key', genres, cache=cache)
+        self.answers = answers
+        self.requests = 0
+
+    def _request(self, params):
+        self.requests += 1
+        answer = self.answers[params['artist']]
+        return io.BytesIO(json.dumps(answer).encode('utf8'))
+
+
+class TestTagCache(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'tags', 'cache.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def testKey(self):
+        self.assertEqual(tagcache.key('artist.gettoptags', 'Beyoncé  '),
+                         tagcache.key('artist.gettoptags', 'BEYONCE'))
+        self.assertNotEqual(
+            tagcache.key('artist.gettoptags', 'ac/dc'),
+            tagcache.key('track.gettoptags', 'ac/dc', 't.n.t.'))
+
+    def testGetPut(self):
+        cache = TagCache(self.path)
+        self.assertEqual((False, None), cache.get('a'))
+        tags = [{'name': 'rock', 'count': 100}]
+        cache.put('a', tags)
+        cache.put('b', [])
+        self.assertEqual((True, tags), cache.get('a'))
+        self.assertEqual((True, []), cache.get('b'))
+        # a new run, or another process, finds the same entries
+        cache.close()
+        self.assertEqual((True, tags), TagCache(self.path).get('a'))
+        process = multiprocessing.Process(
+            target=_store, args=(self.path, 'c', tags))
+        process.start()
+        process.join()
+        self.assertEqual((True, tags), cache.get('c'))
+
+    def testTTL(self):
+        TagCache(self.path).put('a', [{'name': 'rock', 'count': 100}])
+        TagCache(self.path).put('b', [])
+        cache = TagCache(self.path, ttl=60, negative_ttl=0)
+        self.assertTrue(cache.get('a')[0])
+        self.assertFalse(cache.get('b')[0])
+        cache = TagCache(self.path, ttl=0, negative_ttl=60)
+        self.assertFalse(cache.get('a')[0])
+        self.assertTrue(cache.get('b')[0])
+
+    def testTagger(self):
+        genres = {'rock': ['hard rock'], 'pop': []}
+        answers = {
+            'AC/DC': {'toptags': {'tag': [
+                {'name': 'Hard Rock', 'count': 100, 'url': 'x'},
+                {'name': 'pop', 'count': 10, 'url': 'y'}]}},
+            'Nobody': {'error': 6, 'message': 'not found'},
+            'Busy': {'error': 29, 'message': 'rate limit exceeded'},
+        }
+        tagger = _Tagger(genres, TagCache(self.path), answers)
+        self.assertEqual('rock', tagger.tagArtist('AC/DC'))
+        self.assertEqual('rock', tagger.tagArtist('ac/dc'))
+        self.assertIsNone(tagger.tagArtist('Nobody'))
+        self.assertIsNone(tagger.tagArtist('Nobody'))
+        self.assertEqual(2, tagger.requests)
+        # errors that may not happen again are not cached
+        tagger.tagArtist('Busy')
+        tagger.tagArtist('Busy')
+        self.assertEqual(4, tagger.requests)
+        # the raw tags are cached, a new genres file applies to them
+        tagger = _Tagger({'pop': ['hard rock']}, TagCache(self.path), {})
+        self.assertEqual('pop', tagger.tagArtist('AC/DC'))
+        self.assertEqual(0, tagger.requests)
@@ -1,6 +1,10 @@
+import concurrent.futures
 import json
+import threading
+import time
 import unittest
-from lyricsifier.core.tagger import LastFMTagger
+from lyricsifier.core.tagger import BaseTagger, ConcurrentTagger, \
+    LastFMTagger
 from lyricsifier.cli.utils import logging
 
 
@@ -56,3 +60,74 @@ class TestLastFM(unittest.TestCase):
         for tagger in self.taggers:
             self.assertIsNone(tagger.tagTrack(artist, track))
             self.assertIsNone(tagger.tagArtist(artist))
+
+
+class _SlowTagger(BaseTagger):
+
+    def __init__(self):
+        BaseTagger.__init__(self)
+        self._lock = threading.Lock()
+        self.calls = []
+        self.inflight = 0
+        self.max_inflight = 0
+
+    def tagArtist(self, artist):
+        with self._lock:
+            self.calls.append(artist)
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        time.sleep(0.1)
+        with self._lock:
+            self.inflight -= 1
+        if artist == 'down':
+            raise OSError('unreachable')
+        return artist.strip().lower()
+
+    def tagTrack(self, artist, title):
+        return self.tagArtist(artist)
+
+
+class TestConcurrentTagger(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+
+    def testConcurrency(self):
+        # the threads of a worker are not serialized by the tagger
+        slow = _SlowTagger()
+        tagger = ConcurrentTagger(slow)
+        self.assertEqual(str(slow), str(tagger))
+        artists = ['artist {:d}'.format(i) for i in range(16)]
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            tags = list(executor.map(tagger.tagArtist, artists))
+        self.assertLess(time.monotonic() - start, 0.8)
+        self.assertEqual(artists, tags)
+        self.assertEqual(4, slow.max_inflight)
+
+    def testInflightDedup(self):
+        slow = _SlowTagger()
+        tagger = ConcurrentTagger(slow)
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            tags = list(executor.map(
+                tagger.tagArtist, ['AC/DC', 'ac/dc', 'AC/DC ', 'Cher']))
+            self.assertEqual(['rock', 'rock'], list(executor.map(
+                tagger.tagTrack, ['Rock', 'Rock'], ['a', 'b'])))
+        self.assertEqual(['ac/dc', 'ac/dc', 'ac/dc', 'cher'], tags)
+        self.assertEqual(4, len(slow.calls))
+        # waiters get the error of the call they waited for
+        errors = []
+
+        def tag():
+            try:
+                tagger.tagArtist('down')
+            except OSError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=tag) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(3, len(errors))
+        self.assertEqual(5, len(slow.calls))
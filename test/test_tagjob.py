@@ -0,0 +1,124 @@
+import collections
+import csv
+import multiprocessing
+import os
+import tempfile
+import unittest
+from lyricsifier.core.job import TagJob
+from lyricsifier.core.tagger import BaseTagger
+from lyricsifier.cli.utils import logging
+
+
+class _Tagger(BaseTagger):
+
+    def __init__(self):
+        BaseTagger.__init__(self)
+        self.calls = multiprocessing.Value('i', 0)
+        self.track_calls = multiprocessing.Value('i', 0)
+
+    def _count(self, calls):
+        with calls.get_lock():
+            calls.value += 1
+
+    def tagArtist(self, artist):
+        self._count(self.calls)
+        return None if artist.lower() == 'nobody' else artist.strip().lower()
+
+    def tagTrack(self, artist, title):
+        # only the tracks whose number is a multiple of 4 have tags
+        self._count(self.track_calls)
+        return 'track' if int(title.split()[1]) % 4 == 0 else None
+
+
+class TestTagJob(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fin = os.path.join(self.tmpdir.name, 'tracks.tsv')
+        self.fout = os.path.join(self.tmpdir.name, 'tags.tsv')
+        self.artists = ['Rock', 'ROCK ', 'Pop', 'Jazz', 'jazz', 'Nobody']
+        with open(self.fin, 'w', encoding='utf8') as f:
+            f.write('trackid\tartist\ttitle\n')
+            for i in range(60):
+                f.write('{:d}\t{}\tsong {:d}\n'.format(
+                    i, self.artists[i % len(self.artists)], i))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _rows(self, fout):
+        with open(fout, 'r', encoding='utf8') as f:
+            return list(csv.DictReader(f, delimiter='\t'))
+
+    def testByArtist(self):
+        tagger = _Tagger()
+        TagJob(self.fin, self.fout, [tagger], processes=3, batch_size=2,
+               io_concurrency=2, by_artist=True).start()
+        # one call per normalized artist, whatever worker got its tracks
+        self.assertEqual(4, tagger.calls.value)
+        rows = self._rows(self.fout)
+        self.assertEqual(50, len(rows))
+        for row in rows:
+            i = int(row['trackid'])
+            self.assertEqual(self.artists[i % len(self.artists)],
+                             row['artist'])
+            self.assertEqual('song {:d}'.format(i), row['title'])
+            self.assertEqual(row['artist'].strip().lower(), row['tag'])
+        failed = self._rows(os.path.join(self.tmpdir.name, 'tags.failed.tsv'))
+        self.assertEqual(10, len(failed))
+        self.assertEqual({'missing'}, {row['kind'] for row in failed})
+
+    def testGranularity(self):
+        tagger = _Tagger()
+        TagJob(self.fin, self.fout, [tagger], processes=2,
+               granularity='track').start()
+        self.assertEqual(0, tagger.calls.value)
+        self.assertEqual(60, tagger.track_calls.value)
+        rows = self._rows(self.fout)
+        self.assertEqual(sorted(str(i) for i in range(0, 60, 4)),
+                         sorted(row['trackid'] for row in rows))
+        self.assertEqual({'track'}, {row['tag'] for row in rows})
+
+    def testTrackThenArtist(self):
+        tagger = _Tagger()
+        TagJob(self.fin, self.fout, [tagger], processes=2, io_concurrency=2,
+               by_artist=True, granularity='track-then-artist').start()
+        # artists are looked up only for the tracks without tags
+        self.assertEqual(4, tagger.calls.value)
+        self.assertEqual(60, tagger.track_calls.value)
+        rows = self._rows(self.fout)
+        self.assertEqual(50, len(rows))
+        for row in rows:
+            if int(row['trackid']) % 4 == 0:
+                self.assertEqual('track', row['tag'])
+            else:
+                self.assertEqual(row['artist'].strip().lower(), row['tag'])
+
+    def testRepeatedTracks(self):
+        with open(self.fin, 'a', encoding='utf8') as f:
+            for i in range(60):
+                f.write('{:d}\t{}\tsong {:d}\n'.format(
+                    60 + i, self.artists[i % len(self.artists)], i % 30))
+        tagger = _Tagger()
+        TagJob(self.fin, self.fout, [tagger], granularity='track').start()
+        # the tracks coming again are looked up once
+        self.assertEqual(60, tagger.track_calls.value)
+        self.assertEqual(15 + 16, len(self._rows(self.fout)))
+
+    def testError(self):
+        class _Broken(_Tagger):
+            def tagArtist(self, artist):
+                if artist == 'Pop':
+                    raise KeyError(artist)
+                return _Tagger.tagArtist(self, artist)
+
+        TagJob(self.fin, self.fout, [_Broken()], batch_size=4,
+               by_artist=True).start()
+        # an error fails the tracks of the artist, not the whole batch
+        self.assertEqual(40, len(self._rows(self.fout)))
+        failed = self._rows(os.path.join(self.tmpdir.name, 'tags.failed.tsv'))
+        self.assertEqual(
+            {('Pop', 'error'): 10, ('Nobody', 'missing'): 10},
+            collections.Counter((row['artist'], row['kind'])
+                                for row in failed))
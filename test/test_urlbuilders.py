@@ -1,5 +1,9 @@
+import os
+import tempfile
+import time
 import unittest
 from lyricsifier.cli.utils import logging
+from lyricsifier.core.job import URLJob
 from lyricsifier.core.urlbuilder \
     import MetroLyricsURLBuilder, LyricsComURLBuilder, \
     LyricsModeURLBuilder, AZLyricsURLBuilder
@@ -93,3 +97,47 @@ class TestURLBuilders(unittest.TestCase):
         ]
         for t in tracks:
             self.assertEqual(t['url'], builder.build(t['artist'], t['title']))
+
+
+class TestURLJob(unittest.TestCase):
+
+    def setUp(self):
+        logging.loadcfg(default_path='logging_test.json')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.fin = os.path.join(self.tmpdir.name, 'tracks.tsv')
+        with open(self.fin, 'w', encoding='utf8') as f:
+            f.write('artist\ttitle\n')
+            for i in range(20000):
+                f.write('Artist Nº{:d}\tSöng {:d}!\n'.format(i % 500, i))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _lines(self, fout):
+        with open(fout, 'r', encoding='utf8') as f:
+            return f.read().splitlines()
+
+    def testBuild(self):
+        fout = os.path.join(self.tmpdir.name, 'urls.tsv')
+        start = time.perf_counter()
+        URLJob(self.fin, fout).start()
+        elapsed = time.perf_counter() - start
+        print('\n{:d} urls in {:.2f}s'.format(80000, elapsed))
+        lines = self._lines(fout)
+        self.assertEqual('trackid\tartist\ttitle\tsource\turl', lines[0])
+        self.assertEqual(80001, len(lines))
+        self.assertEqual(
+            '7\tArtist Nº7\tSöng 7!\tmetrolyrics\t'
+            'http://www.metrolyrics.com/song-7-lyrics-artist-no7.html',
+            lines[29])
+        fshards = os.path.join(self.tmpdir.name, 'shards.tsv')
+        URLJob(self.fin, fshards, sources=['azlyrics', 'lyricsmode'],
+               processes=3).start()
+        shards = self._lines(fshards)
+        self.assertEqual(lines[0], shards[0])
+        self.assertEqual(
+            sorted(line for line in lines[1:]
+                   if line.split('\t')[3] in ('azlyrics', 'lyricsmode')),
+            sorted(shards[1:]))
+        self.assertEqual(['shards.tsv', 'tracks.tsv', 'urls.tsv'],
+                         sorted(os.listdir(self.tmpdir.name)))